@@ -0,0 +1,58 @@
+"""
+Benchmark of the power spectrum and bandpass filter against the previous implementations.
+
+The previous power spectrum used a complex128 fftn of the whole volume, and the previous
+bandpass two skimage butterworth passes (high-pass then low-pass), each with its own ffts.
+Volumes are float32 cubes of SIZE (512 by default; the previous paths need several GiB of memory there).
+
+Run with: python benchmarks/bench_fft.py [size]
+"""
+import sys
+import timeit
+
+import numpy as np
+from scipy.fft import fftn, fftshift, ifftshift
+from skimage.filters import butterworth
+
+from blik.fft import amplitude_spectrum
+from blik.filters import bandpass
+
+SIZE = 512
+REPEATS = 3
+LOW, HIGH = 0.1, 0.4
+
+
+def power_spectrum_complex128(data):
+    """Previous implementation, complex128 fftn of the recentered volume."""
+    return np.log(np.abs(fftshift(fftn(ifftshift(data)))) + 1)
+
+
+def power_spectrum_rfft(data):
+    spectrum = amplitude_spectrum(data)
+    return np.log1p(spectrum, out=spectrum)
+
+
+def bandpass_skimage(data):
+    """Previous implementation, a butterworth high-pass followed by a low-pass."""
+    return butterworth(butterworth(data, LOW, high_pass=True), HIGH, high_pass=False)
+
+
+def _best_s(func, *args, **kwargs):
+    return min(timeit.repeat(lambda: func(*args, **kwargs), number=1, repeat=REPEATS))
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else SIZE
+    data = np.random.default_rng(0).normal(size=(size,) * 3).astype(np.float32)
+    print(f"{size}^3 float32, best of {REPEATS}")
+    print(f"{'':>15} {'previous':>10} {'rfft':>10}")
+    for name, old, new in (
+        ("power spectrum", power_spectrum_complex128, power_spectrum_rfft),
+        ("bandpass", bandpass_skimage, lambda d: bandpass(d, LOW, HIGH)),
+    ):
+        old_s, new_s = _best_s(old, data), _best_s(new, data)
+        print(f"{name:>15} {old_s:>9.2f}s {new_s:>9.2f}s (x{old_s / new_s:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Time to first slice of blik.reader.read_layers on mrc files of growing size.
+
+Compares the default (memory map below LAZY_SIZE_THRESHOLD, dask above) with loading the
+whole file (lazy=False). Files are written to a temporary directory, so timings are taken
+with a warm page cache.
+
+Run with: python benchmarks/bench_read_mrc.py
+"""
+import tempfile
+import timeit
+from pathlib import Path
+
+import mrcfile
+import numpy as np
+
+from blik.reader import LAZY_SIZE_THRESHOLD, read_layers
+
+SECTION_SHAPE = (2048, 2048)
+# number of float32 sections, 16 MiB each
+SIZES = (1, 4, 16, 32, 128)
+REPEATS = 5
+
+
+def first_slice(path, **kwargs):
+    data = read_layers(path, use_cache=False, **kwargs)[0][0]
+    return np.asarray(data[len(data) // 2])
+
+
+def _best_ms(func, *args, number=1, **kwargs):
+    times = timeit.repeat(lambda: func(*args, **kwargs), number=number, repeat=REPEATS)
+    return min(times) / number * 1000
+
+
+def main():
+    print(f"threshold: {LAZY_SIZE_THRESHOLD / 2**20:.0f} MiB")
+    print(f"{'size':>10} {'default':>10} {'loaded':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in SIZES:
+            path = Path(tmp) / f"{n}.mrc"
+            with mrcfile.new_mmap(path, (n, *SECTION_SHAPE), mrc_mode=2) as mrc:
+                mrc.data[:] = 1
+                mrc.voxel_size = 1
+            size = path.stat().st_size / 2**20
+            default = _best_ms(first_slice, path)
+            loaded = _best_ms(first_slice, path, lazy=False)
+            print(f"{size:>6.0f}MiB {default:>8.2f}ms {loaded:>8.2f}ms")
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import weakref
+from collections import OrderedDict
+from importlib.metadata import version
+from pathlib import Path
+
+import numpy as np
+import pooch
+from cryohub.utils.types import PoseSet
+from scipy.spatial.transform import Rotation
+
+from . import __version__
+
+CACHE_DIR = Path(pooch.os_cache("blik"))
+# parsed particle files are cached here, least recently used ones are dropped above the size limit
+PARTICLE_CACHE_DIR = CACHE_DIR / "particles"
+PARTICLE_CACHE_MAX_BYTES = 2**31
+PARTICLE_SUFFIXES = (".star", ".tbl", ".box", ".cbox")
+# bump when the format of cached particles changes
+PARTICLE_CACHE_FORMAT = 1
+# lazy volumes computed for resampling and picking are kept in memory up to this size
+VOLUME_CACHE_MAX_BYTES = 2**32
+
+# errors of entries that were pickled by other versions of blik, pandas or cryohub, or truncated
+_STALE_ENTRY_ERRORS = (pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, TypeError, ValueError)
+# particle files are read (and cached) by several threads at once
+_particle_cache_lock = threading.Lock()
+
+
+def _particle_cache_path(path, read_kwargs):
+    stat = Path(path).stat()
+    # parsing may change with new versions, so they are part of the key
+    key = json.dumps(
+        [
+            str(Path(path).resolve()),
+            stat.st_size,
+            stat.st_mtime_ns,
+            read_kwargs,
+            PARTICLE_CACHE_FORMAT,
+            __version__,
+            version("cryohub"),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return PARTICLE_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.pkl"
+
+
+def load_cached_particles(path, **read_kwargs):
+    """Load the particles parsed from path with the same read_kwargs, or None if not cached."""
+    cache_path = _particle_cache_path(path, read_kwargs)
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        particles = []
+        for p in cached:
+            quat = p.pop("quat")
+            particles.append(PoseSet(**p, orientation=None if quat is None else Rotation.from_quat(quat)))
+    except FileNotFoundError:
+        return None
+    except (OSError, *_STALE_ENTRY_ERRORS):
+        # unreadable: parse the file again
+        cache_path.unlink(missing_ok=True)
+        return None
+    # mark as recently used, unless it was just evicted
+    try:
+        os.utime(cache_path)
+    except FileNotFoundError:
+        pass
+    return particles
+
+
+def store_cached_particles(path, particles, **read_kwargs):
+    """Cache the particles parsed from path with the given read_kwargs."""
+    cached = [
+        {
+            "position": p.position,
+            "experiment_id": p.experiment_id,
+            "source": str(p.source),
+            "pixel_spacing": p.pixel_spacing,
+            "shift": p.shift,
+            "quat": None if p.orientation is None else p.orientation.as_quat().reshape(-1, 4),
+            "features": p.features,
+        }
+        for p in particles
+    ]
+    cache_path = _particle_cache_path(path, read_kwargs)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(cache_path)
+    _evict_particle_cache()
+
+
+def _evict_particle_cache():
+    with _particle_cache_lock:
+        stats = {}
+        for entry in PARTICLE_CACHE_DIR.glob("*.pkl"):
+            # entries may be removed meanwhile by other processes
+            try:
+                stats[entry] = entry.stat()
+            except FileNotFoundError:
+                continue
+        total = sum(stat.st_size for stat in stats.values())
+        for entry in sorted(stats, key=lambda f: stats[f].st_mtime):
+            if total <= PARTICLE_CACHE_MAX_BYTES:
+                break
+            total -= stats[entry].st_size
+            entry.unlink(missing_ok=True)
+
+
+def clear_particle_cache():
+    """Remove all cached particle files."""
+    shutil.rmtree(PARTICLE_CACHE_DIR, ignore_errors=True)
+
+
+class ArrayCache:
+    """
+    In-memory least recently used cache of arrays derived from a source object (e.g. layer data).
+
+    Entries are keyed by the source and some parameters, and the oldest ones are evicted when
+    in-memory arrays take more than max_bytes (lazy or memory-mapped arrays are free).
+    Entries are only returned for the exact same source object, even if its id is reused,
+    and are dropped as soon as the source is garbage collected (e.g. its layer was removed).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # keys of collected sources that could not be dropped right away
+        self._dead = []
+
+    @staticmethod
+    def _size(value):
+        if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+            return value.nbytes
+        return 0
+
+    def _drop_dead(self):
+        # called with the lock held
+        while self._dead:
+            key, ref = self._dead.pop()
+            if key in self._entries and self._entries[key][0] is ref:
+                del self._entries[key]
+
+    def _source_collected(self, key, ref):
+        self._dead.append((key, ref))
+        # garbage collection can happen anywhere, even while this thread holds the lock
+        if self._lock.acquire(blocking=False):
+            try:
+                self._drop_dead()
+            finally:
+                self._lock.release()
+
+    def get(self, source, *params):
+        """Cached value for source and params, or None."""
+        key = (id(source), *params)
+        with self._lock:
+            self._drop_dead()
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not source:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, source, *params, value):
+        """Cache value for source and params, evicting old entries if needed."""
+        key = (id(source), *params)
+        try:
+            ref = weakref.ref(source, lambda ref: self._source_collected(key, ref))
+        except TypeError:
+            # cannot tell if the source is still alive, so keep it alive
+            ref = lambda: source  # noqa: E731
+        with self._lock:
+            self._drop_dead()
+            self._entries[key] = (ref, value)
+            self._entries.move_to_end(key)
+            total = sum(self._size(v) for _, v in self._entries.values())
+            for old_key in list(self._entries):
+                if total <= self.max_bytes or old_key == key:
+                    break
+                total -= self._size(self._entries.pop(old_key)[1])
+
+    def discard(self, source):
+        """Remove all entries of source."""
+        with self._lock:
+            self._drop_dead()
+            for key in [key for key, (ref, _) in self._entries.items() if ref() is source]:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._dead.clear()
+
+
+_volume_cache = ArrayCache(VOLUME_CACHE_MAX_BYTES)
+
+
+def materialized(data, region=None):
+    """
+    Data, or a region of it (a tuple of slices), as a numpy array.
+
+    Lazy (dask) arrays requested whole are computed once and cached in memory. Regions are
+    taken from the cached copy if there is one, otherwise only the region is computed.
+    Numpy arrays, including memory-mapped ones, are returned as they are (or as views).
+    """
+    if isinstance(data, np.ndarray):
+        return data if region is None else data[tuple(region)]
+    volume = _volume_cache.get(data)
+    if volume is not None:
+        return volume if region is None else volume[tuple(region)]
+    if region is not None:
+        return np.asarray(data[tuple(region)])
+    volume = np.asarray(data)
+    _volume_cache.put(data, value=volume)
+    return volume
+
+
+def release_volume(data):
+    """Drop the cached volume of data, if any (e.g. when its layer is removed)."""
+    _volume_cache.discard(data)
+
+
+def clear_volume_cache():
+    """Drop all cached volumes."""
+    _volume_cache.clear()
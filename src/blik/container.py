@@ -0,0 +1,111 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# blik container files start with this, followed by the format version;
+# older blik files are plain streams of np.save blobs and start with the numpy magic instead
+CONTAINER_MAGIC = b"\x93BLIK"
+CONTAINER_VERSION = 2
+# arrays are stored at offsets aligned to this many bytes
+CONTAINER_ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // CONTAINER_ALIGNMENT) * CONTAINER_ALIGNMENT
+
+
+def is_container(path):
+    """Whether path is a blik container file (as opposed to a legacy np.save stream)."""
+    with open(path, "rb") as f:
+        return f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+
+
+def write_container(path, arrays, metadata, compress=False):
+    """
+    Write a dict of arrays and a json-serializable metadata dict to a blik container.
+
+    The file is made of the magic string, the version, a json header with the dtype, shape
+    and offset of each array, and the raw array data, so each array can be memory-mapped.
+    If compress is True, arrays are zlib-compressed instead (and cannot be memory-mapped).
+    The file is written to a temporary path first, so existing memory maps stay valid.
+    """
+    arrays = {name: np.require(arr, requirements="C") for name, arr in arrays.items()}
+    for name, arr in arrays.items():
+        if arr.dtype.hasobject:
+            raise ValueError(f"cannot write array '{name}' with object dtype")
+    # flat byte views, so no copy is made for uncompressed arrays
+    payloads = {name: memoryview(arr.reshape(-1).view(np.uint8)) for name, arr in arrays.items()}
+    if compress:
+        payloads = {name: zlib.compress(payload) for name, payload in payloads.items()}
+
+    def header_bytes(offsets):
+        header = {
+            "metadata": metadata,
+            "arrays": {
+                name: {
+                    "dtype": arr.dtype.str,
+                    "shape": arr.shape,
+                    "offset": offsets[name],
+                    "nbytes": len(payloads[name]),
+                    "compression": "zlib" if compress else None,
+                }
+                for name, arr in arrays.items()
+            },
+        }
+        return json.dumps(header).encode()
+
+    # offsets depend on the header length, so compute the header with placeholders first
+    # and pad it; 20 digits are enough for any offset
+    placeholder = header_bytes(dict.fromkeys(arrays, 10**20))
+    data_start = _align(len(CONTAINER_MAGIC) + 5 + len(placeholder))
+    offsets = {}
+    offset = data_start
+    for name in arrays:
+        offsets[name] = offset
+        offset = _align(offset + len(payloads[name]))
+    header = header_bytes(offsets).ljust(data_start - len(CONTAINER_MAGIC) - 5)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CONTAINER_MAGIC)
+        f.write(struct.pack("<BI", CONTAINER_VERSION, len(header)))
+        f.write(header)
+        for name in arrays:
+            f.seek(offsets[name])
+            f.write(payloads[name])
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+def read_container(path):
+    """
+    Read a blik container file.
+
+    Returns the metadata dict and a dict of read-only arrays. Uncompressed arrays are
+    memory-mapped, so only the parts that are accessed are actually read from disk.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+            raise ValueError(f"{path} is not a blik container file")
+        version, header_len = struct.unpack("<BI", f.read(5))
+        if version > CONTAINER_VERSION:
+            raise ValueError(f"{path} was written by a newer version of blik (format version {version})")
+        header = json.loads(f.read(header_len))
+
+    arrays = {}
+    with open(path, "rb") as f:
+        for name, info in header["arrays"].items():
+            shape = tuple(info["shape"])
+            if info.get("compression") == "zlib":
+                f.seek(info["offset"])
+                raw = zlib.decompress(f.read(info["nbytes"]))
+                arrays[name] = np.frombuffer(raw, dtype=info["dtype"]).reshape(shape)
+            elif np.prod(shape, dtype=int) == 0:
+                # empty arrays cannot be memory-mapped
+                arrays[name] = np.empty(shape, dtype=info["dtype"])
+            else:
+                arrays[name] = np.memmap(path, dtype=info["dtype"], mode="r", offset=info["offset"], shape=shape)
+    return header["metadata"], arrays
@@ -0,0 +1,171 @@
+import os
+from contextlib import nullcontext
+
+import numpy as np
+from scipy import fft as scipy_fft
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+# number of threads used by each fft (None for all cores)
+FFT_WORKERS = None
+# pyFFTW plans are kept for this many seconds after their last use, so repeated
+# transforms of the same shape (e.g. moving a slider) do not plan again
+FFTW_PLAN_KEEPALIVE = 300
+# averaged spectra read lazy data in blocks of sections of about this size (float32)
+SPECTRUM_CHUNK_BYTES = 2**27
+
+if pyfftw is not None:
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(FFTW_PLAN_KEEPALIVE)
+
+
+def fft_workers(workers=None):
+    """Number of threads to use for an fft."""
+    workers = workers or FFT_WORKERS
+    return workers if workers else os.cpu_count() or 1
+
+
+def _backend():
+    """Use pyFFTW for scipy.fft calls if available (scipy's pocketfft caches its own plans)."""
+    if pyfftw is None:
+        return nullcontext()
+    return scipy_fft.set_backend(pyfftw.interfaces.scipy_fft)
+
+
+def rfftn(data, axes=None, workers=None):
+    """Real-to-complex n-dimensional fft, in single precision (complex64)."""
+    data = np.asarray(data, dtype=np.float32)
+    with _backend():
+        return scipy_fft.rfftn(data, axes=axes, workers=fft_workers(workers))
+
+
+def irfftn(data, s, axes=None, workers=None, overwrite_x=False):
+    """
+    Inverse of rfftn, back to real space in single precision (float32).
+
+    If overwrite_x is True, data may be used as scratch space, which is faster.
+    """
+    data = np.asarray(data, dtype=np.complex64)
+    with _backend():
+        return scipy_fft.irfftn(data, s=s, axes=axes, workers=fft_workers(workers), overwrite_x=overwrite_x)
+
+
+def _centered_spectrum(half, shape, axes):
+    """Full, centered spectrum of shape from the half spectrum of a real fft over axes."""
+    last = axes[-1]
+    size = shape[last]
+    spectrum = np.empty(shape, dtype=np.float32)
+    positive = [slice(None)] * len(shape)
+    positive[last] = slice(0, half.shape[last])
+    spectrum[tuple(positive)] = half
+    # amplitude at -k equals amplitude at k: mirror along all transformed axes
+    negative = [slice(None)] * len(shape)
+    negative[last] = slice(half.shape[last], size)
+    source = [slice(None)] * len(shape)
+    source[last] = slice(size - half.shape[last], 0, -1)
+    mirrored = half[tuple(source)]
+    for ax in axes[:-1]:
+        mirrored = np.roll(np.flip(mirrored, axis=ax), 1, axis=ax)
+    spectrum[tuple(negative)] = mirrored
+    return scipy_fft.fftshift(spectrum, axes=axes)
+
+
+def amplitude_spectrum(data, axes=None, workers=None):
+    """
+    Centered amplitude spectrum (float32) of real data, computed with a real fft.
+
+    The missing half of the spectrum is filled in using its hermitian symmetry.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    axes = tuple(range(data.ndim)) if axes is None else tuple(ax % data.ndim for ax in axes)
+    half = np.abs(rfftn(data, axes=axes, workers=workers))
+    return _centered_spectrum(half, data.shape, axes)
+
+
+def _tiles(block, tile_size):
+    """Split a stack of 2D sections into a stack of non-overlapping square tiles (remainders are dropped)."""
+    ny, nx = block.shape[-2] // tile_size, block.shape[-1] // tile_size
+    block = block[:, : ny * tile_size, : nx * tile_size]
+    tiles = block.reshape(len(block), ny, tile_size, nx, tile_size).swapaxes(2, 3)
+    return tiles.reshape(-1, tile_size, tile_size)
+
+
+def averaged_amplitude_spectrum(data, tile_size=None, workers=None):
+    """
+    Centered 2D amplitude spectrum (float32) averaged over the sections of data (first axis).
+
+    If tile_size is given, sections are split in square tiles and the average is over all tiles.
+    Power spectra are averaged (periodogram averaging), and the square root is returned.
+    Data is read a few sections at a time, so it can be lazy (dask) and bigger than memory.
+    """
+    steps = iter_averaged_amplitude_spectrum(data, tile_size, workers)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def iter_averaged_amplitude_spectrum(data, tile_size=None, workers=None):
+    """
+    Like averaged_amplitude_spectrum, but yields after each block of sections and returns the spectrum.
+
+    So the computation can be followed, and interrupted, from a background worker.
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    shape = data.shape[-2:]
+    if tile_size:
+        tile_size = min(tile_size, *shape)
+        shape = (tile_size, tile_size)
+
+    step = spectrum_step(data)
+
+    power = np.zeros((shape[0], shape[1] // 2 + 1))
+    count = 0
+    for start in range(0, data.shape[0], step):
+        block = np.asarray(data[start : start + step], dtype=np.float32)
+        if tile_size:
+            block = _tiles(block, tile_size)
+        half = np.abs(rfftn(block, axes=(-2, -1), workers=workers))
+        power += np.square(half, out=half).sum(axis=0)
+        count += len(block)
+        yield
+    half = np.sqrt(power / count).astype(np.float32)
+    return _centered_spectrum(half, shape, (0, 1))
+
+
+def spectrum_step(data):
+    """Number of sections of data read at once to compute spectra (about SPECTRUM_CHUNK_BYTES in float32)."""
+    section_bytes = np.prod(data.shape[1:], dtype=int) * np.dtype(np.float32).itemsize
+    return max(1, SPECTRUM_CHUNK_BYTES // max(section_bytes, 1))
+
+
+def radial_profile(spectrum, axes=None):
+    """
+    Radially averaged profile of a centered spectrum over axes (other axes are averaged too).
+
+    Returns the frequencies (cycles/pixel, one bin per pixel of the smallest axis) and the
+    mean spectrum value in each bin, up to the Nyquist frequency.
+    """
+    axes = tuple(range(spectrum.ndim)) if axes is None else tuple(sorted(ax % spectrum.ndim for ax in axes))
+    other_axes = tuple(ax for ax in range(spectrum.ndim) if ax not in axes)
+    values = spectrum.mean(axis=other_axes) if other_axes else spectrum
+    values = values.reshape(-1, *values.shape[-2:])
+    freqs = [scipy_fft.fftshift(scipy_fft.fftfreq(spectrum.shape[ax])) ** 2 for ax in axes]
+    n_bins = max(min(spectrum.shape[ax] for ax in axes) // 2, 1) + 1
+    # squared frequencies of the last two axes; any other axis is looped over to save memory
+    f2_plane = np.add.outer(*freqs[-2:]) if len(freqs) > 1 else freqs[-1]
+    f2_stack = freqs[0] if len(freqs) > 2 else np.zeros(1)
+
+    total = np.zeros(n_bins)
+    count = np.zeros(n_bins)
+    for plane, f2 in zip(values, f2_stack):
+        bins = np.round(np.sqrt(f2_plane + f2) * 2 * (n_bins - 1)).astype(int).ravel()
+        total += np.bincount(bins, weights=plane.ravel(), minlength=n_bins)[:n_bins]
+        count += np.bincount(bins, minlength=n_bins)[:n_bins]
+    return np.arange(n_bins) / (2 * (n_bins - 1)), total / np.maximum(count, 1)
@@ -0,0 +1,213 @@
+import threading
+from collections import OrderedDict
+
+import dask.array as da
+import numpy as np
+from scipy import ndimage
+from scipy.fft import fftfreq
+
+from .cache import ArrayCache
+from .fft import irfftn, rfftn
+
+# lazy volumes (and stacks of 2D images in memory) are bandpassed in slabs of z sections of about this size
+BANDPASS_CHUNK_BYTES = 2**28
+# slabs overlap by this many wavelengths of the lowest cutoff, to hide edge effects
+BANDPASS_OVERLAP_WAVELENGTHS = 2
+# transfer functions of the most recently used shapes and cutoffs are kept up to this size
+BANDPASS_TRANSFER_CACHE_MAX_BYTES = 2**28
+# gaussian kernels are truncated at this many sigmas (also the overlap of lazy chunks)
+GAUSSIAN_TRUNCATE = 4.0
+# smoothed copies of recently used data are kept in memory up to this size
+SMOOTHING_CACHE_MAX_BYTES = 2**31
+
+_smoothing_cache = ArrayCache(SMOOTHING_CACHE_MAX_BYTES)
+_transfer_cache = OrderedDict()
+_transfer_cache_lock = threading.Lock()
+
+
+def _squared_frequencies(shape):
+    """Squared spatial frequencies (cycles/pixel) of the rfftn grid of shape, as float32."""
+    f2 = np.zeros((*shape[:-1], shape[-1] // 2 + 1), dtype=np.float32)
+    for ax, size in enumerate(shape):
+        freq = fftfreq(size).astype(np.float32)[: f2.shape[ax]]
+        f2 += (freq**2).reshape([-1 if i == ax else 1 for i in range(f2.ndim)])
+    return f2
+
+
+def _bandpass_transfer(shape, low, high, order=2):
+    # computed in place as much as possible, these can be as big as the data
+    q = _squared_frequencies(shape)
+    if low > 0:
+        q /= np.float32(low**2)
+        q **= order
+        transfer = q + 1
+        np.divide(q, transfer, out=transfer)
+        if high > 0:
+            # rescale the high-pass term to the low-pass cutoff
+            q *= np.float32((low / high) ** (2 * order))
+            q += 1
+            transfer /= q
+    elif high > 0:
+        q /= np.float32(high**2)
+        q **= order
+        q += 1
+        transfer = np.reciprocal(q, out=q)
+    else:
+        transfer = np.ones_like(q)
+    return transfer
+
+
+def bandpass_transfer(shape, low, high, order=2):
+    """
+    Real-fft transfer function of a butterworth bandpass filter for data of the given shape.
+
+    Equivalent to a squared butterworth high-pass at `low` followed by a low-pass at `high`
+    (as in skimage.filters.butterworth); cutoffs are in cycles/pixel and 0 disables each side.
+    The result is float32 and read-only, as recently used ones are cached (up to
+    BANDPASS_TRANSFER_CACHE_MAX_BYTES, bigger ones are not cached at all).
+    """
+    key = (tuple(shape), low, high, order)
+    with _transfer_cache_lock:
+        transfer = _transfer_cache.get(key)
+        if transfer is not None:
+            _transfer_cache.move_to_end(key)
+            return transfer
+    transfer = _bandpass_transfer(*key)
+    transfer.flags.writeable = False
+    if transfer.nbytes <= BANDPASS_TRANSFER_CACHE_MAX_BYTES:
+        with _transfer_cache_lock:
+            _transfer_cache[key] = transfer
+            total = sum(t.nbytes for t in _transfer_cache.values())
+            while total > BANDPASS_TRANSFER_CACHE_MAX_BYTES:
+                total -= _transfer_cache.popitem(last=False)[1].nbytes
+    return transfer
+
+
+def _bandpass_block(block, low, high, order, axes, workers=None):
+    shape = tuple(block.shape[ax] for ax in axes)
+    transformed = rfftn(block, axes=axes, workers=workers)
+    transformed *= bandpass_transfer(shape, low, high, order)
+    return irfftn(transformed, s=shape, axes=axes, workers=workers, overwrite_x=True)
+
+
+def _slab_chunks(size, slab, depth):
+    """Chunk sizes along an axis of size, merging a short trailing chunk so all are >= depth."""
+    chunks = [slab] * (size // slab)
+    if size % slab:
+        chunks.append(size % slab)
+    if len(chunks) > 1 and chunks[-1] < depth:
+        chunks[-2] += chunks.pop()
+    return tuple(chunks)
+
+
+def bandpass(data, low, high, order=2, is_2D_data=False, workers=None):
+    """
+    Butterworth bandpass filter in float32, with a single real fft and transfer multiply.
+
+    Numpy inputs are filtered at once. Dask inputs are filtered lazily in slabs of z sections:
+    for 2D data (a stack of images) each section is filtered independently, so the result is
+    exact; volumes are filtered per slab with overlapping (reflected) borders, which closely
+    approximates filtering the whole volume at once.
+
+    workers: number of threads used by each fft (see blik.fft)
+    """
+    axes = tuple(range(data.ndim))[-2:] if is_2D_data else tuple(range(data.ndim))
+    if not isinstance(data, da.Array):
+        return _bandpass_block(data, low, high, order, axes, workers)
+
+    section_bytes = np.prod(data.shape[1:], dtype=int) * np.dtype(np.float32).itemsize
+    slab = max(1, BANDPASS_CHUNK_BYTES // max(section_bytes, 1))
+    if is_2D_data or data.ndim < 3:
+        depth = 0
+    else:
+        # the lowest cutoff has the widest spatial extent; without any, sections are independent
+        cutoff = low if low > 0 else high
+        depth = int(np.ceil(BANDPASS_OVERLAP_WAVELENGTHS / cutoff)) if cutoff > 0 else 0
+        slab = max(slab, depth)
+    if slab >= data.shape[0]:
+        depth = 0
+
+    data = data.rechunk((_slab_chunks(data.shape[0], slab, depth), *data.shape[1:]))
+    kwargs = {"low": low, "high": high, "order": order, "axes": axes, "workers": workers, "dtype": np.float32}
+    if not depth:
+        return data.map_blocks(_bandpass_block, **kwargs)
+    return data.map_overlap(
+        _bandpass_block,
+        depth={ax: depth if ax == 0 else 0 for ax in range(data.ndim)},
+        boundary="reflect",
+        **kwargs,
+    )
+
+
+def iter_bandpass(data, low, high, order=2, is_2D_data=False, workers=None):
+    """
+    Like bandpass, but yields after each step so it can be followed (and interrupted) from a
+    background worker; returns the filtered data.
+
+    Stacks of 2D images in memory are filtered one slab of sections at a time (which is exact),
+    volumes yield between the forward and inverse ffts. Dask inputs stay lazy (see bandpass).
+    """
+    if isinstance(data, da.Array):
+        return bandpass(data, low, high, order, is_2D_data, workers)
+    axes = tuple(range(data.ndim))[-2:] if is_2D_data else tuple(range(data.ndim))
+    if is_2D_data and data.ndim > 2:
+        filtered = np.empty(data.shape, dtype=np.float32)
+        section_bytes = np.prod(data.shape[1:], dtype=int) * np.dtype(np.float32).itemsize
+        slab = max(1, BANDPASS_CHUNK_BYTES // max(section_bytes, 1))
+        for start in range(0, data.shape[0], slab):
+            block = data[start : start + slab]
+            filtered[start : start + slab] = _bandpass_block(block, low, high, order, axes, workers)
+            yield
+        return filtered
+
+    shape = tuple(data.shape[ax] for ax in axes)
+    transformed = rfftn(data, axes=axes, workers=workers)
+    yield
+    transformed *= bandpass_transfer(shape, low, high, order)
+    return irfftn(transformed, s=shape, axes=axes, workers=workers, overwrite_x=True)
+
+
+def slab_average(data, index, thickness=1):
+    """Mean (float32) of `thickness` sections of data along the first axis, centered on index."""
+    start = min(max(0, index - thickness // 2), max(0, data.shape[0] - thickness))
+    slab = np.asarray(data[start : start + thickness], dtype=np.float32)
+    return slab.mean(axis=0, dtype=np.float32)
+
+
+def bandpass_from_fft(transformed, shape, low, high, order=2, workers=None):
+    """
+    Bandpass filter data whose rfftn (over all axes) was already computed.
+
+    Useful to try many cutoffs on the same data, as only the inverse fft is repeated.
+    """
+    transformed = transformed * bandpass_transfer(tuple(shape), low, high, order)
+    return irfftn(transformed, s=shape, workers=workers, overwrite_x=True)
+
+
+def _gaussian_block(block, sigma):
+    return ndimage.gaussian_filter(np.asarray(block, dtype=np.float32), sigma, truncate=GAUSSIAN_TRUNCATE)
+
+
+def gaussian_smooth(data, sigma):
+    """
+    Gaussian smoothed copy of data in float32 (sigma can be given per axis, 0 to skip one).
+
+    Dask inputs are smoothed lazily, chunk by chunk with enough overlap to match the eager result.
+    Results are cached per (data, sigma), so going back to a previous sigma is instant.
+    """
+    sigma = tuple(np.broadcast_to(np.asarray(sigma, dtype=float), (data.ndim,)).round(3))
+    smoothed = _smoothing_cache.get(data, sigma)
+    if smoothed is not None:
+        return smoothed
+
+    if isinstance(data, da.Array):
+        depth = {ax: int(np.ceil(GAUSSIAN_TRUNCATE * s)) for ax, s in enumerate(sigma)}
+        # each chunk needs to be at least as big as the overlap
+        data_ = data.rechunk({ax: max(d, data.chunksize[ax]) for ax, d in depth.items()})
+        smoothed = data_.map_overlap(
+            _gaussian_block, depth=depth, boundary="reflect", dtype=np.float32, sigma=sigma
+        )
+    else:
+        smoothed = _gaussian_block(data, sigma)
+    _smoothing_cache.put(data, sigma, value=smoothed)
+    return smoothed
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pooch
+
+# binned versions of big images are cached here, one directory per source file;
+# least recently used ones are dropped above the size limit
+PYRAMID_CACHE_DIR = Path(pooch.os_cache("blik")) / "pyramids"
+PYRAMID_CACHE_MAX_BYTES = 2**34
+# images bigger than this get a multiscale pyramid
+PYRAMID_SIZE_THRESHOLD = 2**30
+# stop binning once the binned axes are all smaller than this
+PYRAMID_MIN_SIZE = 256
+# approximate amount of source data read at once while binning
+PYRAMID_BLOCK_BYTES = 2**27
+
+
+def _source_signature(source):
+    stat = Path(source).stat()
+    return {
+        "source": str(Path(source).resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _cache_dir(source):
+    key = hashlib.sha1(str(Path(source).resolve()).encode()).hexdigest()
+    return PYRAMID_CACHE_DIR / f"{Path(source).stem}-{key[:16]}"
+
+
+def _bin_by_2(src, dst, binned_axes):
+    """Mean-bin src by 2 along binned_axes into dst, a few sections at a time."""
+    factors = [2 if ax in binned_axes else 1 for ax in range(src.ndim)]
+    section_bytes = np.prod(src.shape[1:]) * np.dtype(src.dtype).itemsize * factors[0]
+    step = max(1, PYRAMID_BLOCK_BYTES // max(section_bytes, 1))
+    crop = tuple(slice(0, size * f) for size, f in zip(dst.shape[1:], factors[1:]))
+    for start in range(0, dst.shape[0], step):
+        stop = min(start + step, dst.shape[0])
+        block = np.asarray(src[(slice(start * factors[0], stop * factors[0]), *crop)], dtype=np.float32)
+        shape = [dim for size, f in zip((stop - start, *dst.shape[1:]), factors) for dim in (size, f)]
+        dst[start:stop] = block.reshape(shape).mean(axis=tuple(range(1, 2 * src.ndim, 2)))
+
+
+def _binned_axes(data, stack=False):
+    return (data.ndim - 2, data.ndim - 1) if stack else tuple(range(data.ndim))
+
+
+def _level_dtype(data):
+    return data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype(np.float32)
+
+
+def _level_shapes(shape, binned_axes):
+    """Shapes of the binned levels of a pyramid, from the least to the most binned."""
+    shapes = []
+    while max(shape[ax] for ax in binned_axes) > PYRAMID_MIN_SIZE:
+        shape = tuple(size // 2 if ax in binned_axes else size for ax, size in enumerate(shape))
+        shapes.append(shape)
+    return shapes
+
+
+def _build_pyramid(data, cache_dir, binned_axes):
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    cache_dir.mkdir(parents=True)
+    src = data
+    shapes = _level_shapes(data.shape, binned_axes)
+    for i, shape in enumerate(shapes, 1):
+        dst = np.lib.format.open_memmap(cache_dir / f"level_{i}.npy", mode="w+", dtype=_level_dtype(data), shape=shape)
+        _bin_by_2(src, dst, binned_axes)
+        dst.flush()
+        src = dst
+    return len(shapes)
+
+
+def _levels(data, cache_dir, n_levels):
+    return [data] + [np.load(cache_dir / f"level_{i}.npy", mmap_mode="r") for i in range(1, n_levels + 1)]
+
+
+def load_cached_pyramid(data, source):
+    """Multiscale pyramid of the data if it is cached and up to date with the source file, or None."""
+    meta_path = _cache_dir(source) / "meta.json"
+    signature = _source_signature(source)
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return None
+    if {k: meta.get(k) for k in signature} != signature:
+        return None
+    # mark as recently used
+    os.utime(meta_path)
+    return _levels(data, meta_path.parent, meta["levels"])
+
+
+def build_pyramid(data, source, stack=False):
+    """
+    Build and cache the multiscale pyramid of the data, from full resolution to the most binned level.
+
+    Each level is binned 2x (only in xy for stacks) with respect to the previous one.
+    Binned levels are cached as memory-mapped npy files in PYRAMID_CACHE_DIR. This reads the
+    whole data, so it can take a while for big images.
+    """
+    cache_dir = _cache_dir(source)
+    n_levels = _build_pyramid(data, cache_dir, _binned_axes(data, stack))
+    # written last, so interrupted builds are not picked up
+    (cache_dir / "meta.json").write_text(json.dumps({**_source_signature(source), "levels": n_levels}))
+    _evict_pyramid_cache(keep=cache_dir)
+    return _levels(data, cache_dir, n_levels)
+
+
+def get_pyramid(data, source, stack=False):
+    """
+    Get a multiscale pyramid of the data, from full resolution to the most binned level.
+
+    The cached pyramid is reused if the source file did not change size or modification time,
+    otherwise it is built again (see build_pyramid).
+    """
+    pyramid = load_cached_pyramid(data, source)
+    if pyramid is None:
+        pyramid = build_pyramid(data, source, stack=stack)
+    return pyramid
+
+
+class PendingLevel:
+    """
+    Binned level of a pyramid that is still being built.
+
+    Until the built level is set with `fill`, it is read by striding the full resolution data,
+    so it can be displayed right away without reading the whole image.
+    """
+
+    def __init__(self, data, shape, factors):
+        self._data = data
+        self._strides = tuple(slice(0, size * f, f) for size, f in zip(shape, factors))
+        self._built = None
+        self.shape = shape
+        self.dtype = _level_dtype(data)
+        self.ndim = len(shape)
+        self.size = int(np.prod(shape))
+
+    def fill(self, built):
+        """Read from the built level from now on."""
+        self._built = built
+
+    def __getitem__(self, key):
+        if self._built is not None:
+            return self._built[key]
+        return np.asarray(self._data[self._strides][key], dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+def pending_pyramid(data, stack=False):
+    """
+    Multiscale pyramid of the data whose binned levels are PendingLevels, to fill once built.
+
+    Has the same levels as build_pyramid, so layers can be multiscale before the pyramid is built.
+    """
+    binned_axes = _binned_axes(data, stack)
+    return [data] + [
+        PendingLevel(data, shape, [2**i if ax in binned_axes else 1 for ax in range(data.ndim)])
+        for i, shape in enumerate(_level_shapes(data.shape, binned_axes), 1)
+    ]
+
+
+def _evict_pyramid_cache(keep=None):
+    # pyramids being built have no meta.json yet and are left alone
+    entries = sorted(
+        (d for d in PYRAMID_CACHE_DIR.iterdir() if (d / "meta.json").exists()),
+        key=lambda d: (d / "meta.json").stat().st_mtime,
+    )
+    sizes = {d: sum(f.stat().st_size for f in d.iterdir()) for d in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= PYRAMID_CACHE_MAX_BYTES:
+            break
+        if entry == keep:
+            continue
+        total -= sizes[entry]
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def clear_pyramid_cache():
+    """Remove all cached pyramids."""
+    shutil.rmtree(PYRAMID_CACHE_DIR, ignore_errors=True)
@@ -1,16 +1,47 @@
+import logging
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from importlib.metadata import version
 from pathlib import Path
 from uuid import uuid1
 
 import cryohub
+import dask.array as da
+import mrcfile
 import numpy as np
 import pandas as pd
-from cryotypes.image import ImageProtocol
+from cryohub.utils.generic import guess_name
+from cryotypes.image import Image, ImageProtocol, validate_image
 from cryotypes.poseset import PoseSetProtocol
-from scipy.spatial.transform import Rotation
+from dask.base import tokenize
+
+from .cache import PARTICLE_SUFFIXES, load_cached_particles, store_cached_particles
+from .container import is_container, read_container
+from .pyramid import PYRAMID_SIZE_THRESHOLD, build_pyramid, get_pyramid, load_cached_pyramid, pending_pyramid
+from .utils import (
+    IDENTITY_QUAT,
+    MAX_DISPLAYED_ORIENTATIONS,
+    QUAT_COLS,
+    generate_vectors,
+    invert_xyz,
+    stratified_subsample,
+    surface_colormap,
+)
+
+logger = logging.getLogger(__name__)
+
+MRC_SUFFIXES = (".mrc", ".mrcs", ".st", ".map", ".rec")
+# images bigger than this are opened as dask arrays, smaller ones as plain memory maps,
+# unless lazy is explicitly requested or refused
+LAZY_SIZE_THRESHOLD = 2**28
+# approximate size of each chunk (slab of z sections) of lazily opened images
+LAZY_CHUNK_BYTES = 2**24
+
+# pending pyramids of the sources whose pyramid is being built in the background
+_pyramid_builds = {}
 
-from .utils import generate_vectors, invert_xyz
 
 def get_reader(path):
     return read_layers
@@ -22,9 +53,9 @@ def _construct_positions_layer(
     feat_defaults = (
         pd.DataFrame(features.iloc[-1].to_dict(), index=[0])
         if len(features)
-        else pd.DataFrame()
+        else pd.DataFrame(index=[0])
     )
-    feat_defaults["orientation"] = np.array(Rotation.identity(), dtype=object)
+    feat_defaults[QUAT_COLS] = IDENTITY_QUAT
     if coords is not None:
         coords = invert_xyz(coords)
     return (
@@ -57,7 +88,13 @@ def _construct_orientations_layer(
         vec_data = None
         vec_color = "blue"
     else:
-        vec_data, vec_color = generate_vectors(coords, features["orientation"])
+        orientations = features.orientation.rotation
+        if len(coords) > MAX_DISPLAYED_ORIENTATIONS:
+            # too many to display: show a spatially uniform subset (all data is in the points layer)
+            shown = stratified_subsample(coords, MAX_DISPLAYED_ORIENTATIONS)
+            coords = coords[shown]
+            orientations = orientations[shown]
+        vec_data, vec_color = generate_vectors(coords, orientations)
         vec_data = invert_xyz(vec_data)  # napari works in zyx order
     return (
         vec_data,
@@ -97,12 +134,11 @@ def construct_particle_layer_tuples(
     p_id = p_id if p_id is not None else uuid1()
 
     if features is None:
-        features = pd.DataFrame()
+        features = pd.DataFrame(index=pd.RangeIndex(0 if coords is None else len(coords)))
 
-    if "orientation" not in features.columns:
-        features["orientation"] = np.array(
-            [] if coords is None else Rotation.identity(len(coords)), dtype=object
-        )
+    if not set(QUAT_COLS).issubset(features.columns):
+        # also takes care of converting legacy columns of Rotation objects
+        features.orientation.set(features.orientation.quat)
 
     # divide by scale top keep constant size. TODO: remove after vispy 0.12 which fixes this
     pos = _construct_positions_layer(
@@ -149,7 +185,7 @@ def read_particles(particles, name_suffix="particle"):
         shift_cols = ["shift_x", "shift_y", "shift_z"]
         features[shift_cols] = particles.shift
     if particles.orientation is not None:
-        features["orientation"] = np.asarray(particles.orientation, dtype=object)
+        features[QUAT_COLS] = particles.orientation.as_quat().reshape(-1, 4)
 
     return construct_particle_layer_tuples(
         coords=coords,
@@ -169,6 +205,7 @@ def construct_image_layer_tuple(
     source="",
     **image_kwargs,
 ):
+    full_res = data[0] if image_kwargs.get("multiscale", False) else data
     return (
         data,
         {
@@ -180,7 +217,7 @@ def construct_image_layer_tuple(
             "blending": "translucent",
             "projection_mode": "mean",
             "depiction": "plane",
-            "plane": {"thickness": 5, "position": np.array(data.shape) / 2},
+            "plane": {"thickness": 5, "position": np.array(full_res.shape) / 2},
             "rendering": "average",
             # "axis_labels": ('z', 'y', 'x'),
             "units": 'angstrom',
@@ -190,13 +227,71 @@ def construct_image_layer_tuple(
     )
 
 
-def read_image(image):
+def _use_pyramid(source, pyramid):
+    """Fill the pending pyramids read from source with the built levels."""
+    for pending in _pyramid_builds.pop(source, []):
+        for level, built in zip(pending[1:], pyramid[1:]):
+            level.fill(built)
+
+
+def _build_pyramid_in_background(data, source, stack=False):
+    """
+    Build the pyramid of an image in a background worker, returning a pending pyramid meanwhile.
+
+    The pending pyramid is filled with the built levels once done, so layers can be multiscale
+    right away. Only done if there is a gui (event loop) to report back to, otherwise returns None.
+    """
+    # imported here, so reading does not need qt
+    from napari.qt.threading import thread_worker
+    from qtpy.QtWidgets import QApplication
+
+    source = str(source)
+    if QApplication.instance() is None:
+        return None
+    pending = pending_pyramid(data, stack=stack)
+    if source in _pyramid_builds:
+        _pyramid_builds[source].append(pending)
+        return pending
+    _pyramid_builds[source] = [pending]
+    worker = thread_worker(build_pyramid, progress={"total": 0, "desc": f"building pyramid of {Path(source).name}"})(
+        data, source, stack=stack
+    )
+    worker.errored.connect(lambda _: _pyramid_builds.pop(source, None))
+    worker.returned.connect(partial(_use_pyramid, source))
+    worker.start()
+    return pending
+
+
+def read_image(image, multiscale=None):
+    """
+    Convert an image into a napari layer.
+
+    If multiscale is True, a multiscale pyramid is used (and built if not cached yet).
+    If multiscale is None, a cached pyramid is used for images bigger than PYRAMID_SIZE_THRESHOLD
+    that come from a file; if not cached yet, the pyramid is built in the background and its
+    binned levels are read by striding the full resolution image until then, so opening the
+    file stays fast.
+    """
+    data = image.data
+    build_now = multiscale is not None
+    if multiscale is None:
+        multiscale = data.nbytes > PYRAMID_SIZE_THRESHOLD
+    if multiscale and data.ndim == 3 and image.source and Path(image.source).is_file():
+        if build_now:
+            pyramid = get_pyramid(data, image.source, stack=image.stack)
+        else:
+            pyramid = load_cached_pyramid(data, image.source)
+            if pyramid is None:
+                pyramid = _build_pyramid_in_background(data, image.source, stack=image.stack) or [data]
+        if len(pyramid) > 1:
+            data = pyramid
     return construct_image_layer_tuple(
-        data=image.data,
+        data=data,
         scale=image.pixel_spacing,
         exp_id=image.experiment_id,
         stack=image.stack,
         source=image.source,
+        multiscale=isinstance(data, list),
     )
 
 
@@ -234,7 +329,8 @@ def read_segmentation(image):
 
 
 
-def read_surface_picks(path):
+def _read_surface_picks_stream(path):
+    """Read the legacy .picks format, a stream of np.save blobs with the experiment id at the end."""
     lines = []
     with open(path, "rb") as f:
         scale = np.load(f)
@@ -246,6 +342,34 @@ def read_surface_picks(path):
             except ValueError:
                 break
         exp_id = f.read().decode()
+    return lines, scale, surf_id, edge_color_cycle, exp_id
+
+
+def read_surface_picks(path, surface_ids=None):
+    """
+    Read surface picks into a shapes layer tuple.
+
+    If surface_ids is given, only lines belonging to those surfaces are loaded
+    (lines are memory-mapped, so the rest is not read from disk).
+    """
+    if is_container(path):
+        meta, arrays = read_container(path)
+        scale = np.array(arrays["scale"])
+        surf_id = np.array(arrays["surface_id"])
+        edge_color_cycle = np.array(arrays["edge_color_cycle"])
+        exp_id = meta["experiment_id"]
+        points, offsets = arrays["points"], arrays["line_offsets"]
+        line_idx = np.arange(len(surf_id))
+        if surface_ids is not None:
+            line_idx = np.flatnonzero(np.isin(surf_id, surface_ids))
+        lines = [np.array(points[offsets[i] : offsets[i + 1]]) for i in line_idx]
+        surf_id = surf_id[line_idx]
+    else:
+        lines, scale, surf_id, edge_color_cycle, exp_id = _read_surface_picks_stream(path)
+        if surface_ids is not None:
+            keep = np.isin(surf_id, surface_ids)
+            lines = [line for line, k in zip(lines, keep) if k]
+            surf_id = surf_id[keep]
 
     return (
         lines,
@@ -255,7 +379,7 @@ def read_surface_picks(path):
             "metadata": {"experiment_id": exp_id},
             "scale": scale,
             "features": {"surface_id": surf_id},
-            "feature_defaults": {"surface_id": surf_id.max() + 1},
+            "feature_defaults": {"surface_id": surf_id.max() + 1 if len(surf_id) else 0},
             "edge_color_cycle": edge_color_cycle,
             "edge_color": "surface_id",
             "shape_type": "path",
@@ -267,43 +391,173 @@ def read_surface_picks(path):
     )
 
 
-def read_surface(path):
+def _read_surface_stream(path):
+    """Read the legacy .surf format, a stream of np.save blobs with the experiment id at the end."""
     with open(path, "rb") as f:
         scale = np.load(f)
-        # TODO: needs to exposed in napari
-        # colormap = np.load(f)
         data = tuple(np.load(f) for _ in range(3))
         exp_id = f.read().decode()
+    return data, scale, {"experiment_id": exp_id}
 
-    return (
-        data,
-        {
-            "name": f"{exp_id} - surface",
-            "metadata": {"experiment_id": exp_id},
-            "shading": "smooth",
-            "scale": scale,
-            # TODO: needs to exposed in napari
-            # colormap=colormap
-            # "axis_labels": ('z', 'y', 'x'),
-            "units": 'angstrom',
-        },
-        "surface",
+
+def read_surface(path):
+    """
+    Read a surface mesh into a surface layer tuple.
+
+    If the file holds the surface grid parameters, they are added to the layer metadata
+    so particles can be generated or volumes resampled from the surfaces again.
+    """
+    if not is_container(path):
+        data, scale, metadata = _read_surface_stream(path)
+        colormap = None
+    else:
+        meta, arrays = read_container(path)
+        scale = np.array(arrays["scale"])
+        data = tuple(np.array(arrays[name]) for name in ("vertices", "faces", "values"))
+        metadata = {"experiment_id": meta["experiment_id"]}
+        colormap = None
+        if "surface_colors" in arrays:
+            metadata["surface_colors"] = np.array(arrays["surface_colors"])
+            colormap = surface_colormap(metadata["surface_colors"])
+        if "surface_params" in meta:
+            points, offsets = arrays["surface_points"], arrays["surface_line_offsets"]
+            line_starts = np.cumsum([0, *arrays["surface_line_counts"]])
+            metadata["surface_params"] = [
+                {
+                    **params,
+                    "points": [np.array(points[offsets[i] : offsets[i + 1]]) for i in range(start, stop)],
+                    "inside_point": None if params["inside_point"] is None else np.array(params["inside_point"]),
+                }
+                for params, start, stop in zip(meta["surface_params"], line_starts[:-1], line_starts[1:])
+            ]
+
+    exp_id = metadata["experiment_id"]
+    kwargs = {
+        "name": f"{exp_id} - surface",
+        "metadata": metadata,
+        "shading": "smooth",
+        "scale": scale,
+        # "axis_labels": ('z', 'y', 'x'),
+        "units": 'angstrom',
+    }
+    if colormap is not None:
+        kwargs["colormap"] = colormap
+    return (data, kwargs, "surface")
+
+
+def _z_slab_chunks(shape, dtype):
+    """Dask chunks spanning whole sections, with as many sections as fit in LAZY_CHUNK_BYTES."""
+    section_bytes = np.prod(shape[1:], dtype=int) * np.dtype(dtype).itemsize
+    return (max(1, LAZY_CHUNK_BYTES // max(section_bytes, 1)), *shape[1:])
+
+
+class _SectionReader:
+    """Minimal array-like around a memmap, so dask reads it chunk by chunk instead of copying it."""
+
+    def __init__(self, memmap):
+        self._memmap = memmap
+        self.shape = memmap.shape
+        self.dtype = memmap.dtype
+        self.ndim = memmap.ndim
+
+    def __getitem__(self, key):
+        return np.asarray(self._memmap[key])
+
+
+def read_mrc(path, lazy=None, name_regex=None, names=None, **kwargs):
+    """
+    Read an mrc file as a memory-mapped image.
+
+    If lazy is None, files bigger than LAZY_SIZE_THRESHOLD are opened lazily and smaller
+    ones are returned as a copy-on-write memory map, so no file is read up front. Lazy data
+    is a dask array chunked in slabs of z sections, so only the displayed sections are read.
+    Pass lazy=False to load the whole file in memory.
+    """
+    path = Path(path)
+    exp_id = guess_name(path, name_regex)
+    if names is not None and exp_id not in names:
+        return []
+    load = lazy is False
+    if lazy is None:
+        lazy = path.stat().st_size > LAZY_SIZE_THRESHOLD
+
+    # the memmap stays valid after closing the file
+    with mrcfile.mmap(path, "r", permissive=True) as mrc:
+        data = mrc.data
+        offset = mrc.header.nbytes + mrc.extended_header.nbytes
+        # TODO: support anisotropic pixel sizes
+        pixel_size = float(mrc.voxel_size.x) or 0
+        stack = bool(mrc.is_image_stack() or mrc.is_volume_stack())
+
+    if lazy:
+        stat = path.stat()
+        data = da.from_array(
+            _SectionReader(data),
+            chunks=_z_slab_chunks(data.shape, data.dtype),
+            name=f"mrc-{tokenize(str(path), stat.st_size, stat.st_mtime_ns)}",
+            meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+        )
+    elif load:
+        data = np.array(data)
+    else:
+        # copy-on-write, so small images (e.g. labels) can be edited without touching the file
+        data = np.memmap(path, dtype=data.dtype, mode="c", offset=offset, shape=data.shape)
+
+    img = Image(
+        data=data,
+        experiment_id=exp_id,
+        pixel_spacing=pixel_size,
+        source=path,
+        stack=stack,
     )
+    return [validate_image(img, coerce=True)]
+
+
+def _read_path(path, use_cache=True, **kwargs):
+    """Read a single path, returning a list of layer tuples (blik formats) or cryohub objects."""
+    start = time.perf_counter()
+    if use_cache and path.suffix in PARTICLE_SUFFIXES:
+        data = load_cached_particles(path, **kwargs)
+        if data is None:
+            data = cryohub.read(path, **kwargs)
+            store_cached_particles(path, data, **kwargs)
+    elif path.suffix == ".picks":
+        data = [read_surface_picks(path)]
+    elif path.suffix == ".surf":
+        data = [read_surface(path)]
+    elif path.suffix in MRC_SUFFIXES:
+        data = read_mrc(path, **kwargs)
+    else:
+        data = cryohub.read(path, **kwargs)
+    logger.info("read %s in %.3fs", path, time.perf_counter() - start)
+    return data
 
 
-def read_layers(*paths, **kwargs):
+def read_layers(*paths, workers=None, multiscale=None, use_cache=True, **kwargs):
+    """
+    Read any number of paths into layer data tuples.
+
+    Files are parsed concurrently in a thread pool with the given number of workers
+    (None for an automatic amount, 1 for sequential reading). Time taken by each file
+    is logged at INFO level. Images are read as multiscale pyramids if multiscale is True
+    (None to decide based on size). Parsed particle files are cached on disk unless
+    use_cache is False. Other kwargs are passed to cryohub.read.
+    """
+    paths = [Path(path) for path in paths]
+    if workers == 1 or len(paths) < 2:
+        results = [_read_path(path, use_cache=use_cache, **kwargs) for path in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(partial(_read_path, use_cache=use_cache, **kwargs), paths))
+
     layers = []
-    cryohub_paths = []
-    for path in paths:
-        path = Path(path)
-        if path.suffix == ".picks":
-            layers.append(read_surface_picks(path))
-        if path.suffix == ".surf":
-            layers.append(read_surface(path))
+    obj_list = []
+    for path, data in zip(paths, results):
+        if path.suffix in (".picks", ".surf"):
+            layers.extend(data)
         else:
-            cryohub_paths.append(path)
+            obj_list.extend(data)
 
-    obj_list = cryohub.read(*cryohub_paths, **kwargs)
     # sort so we get images first, better for some visualization circumstances
     for obj in sorted(obj_list, key=lambda x: not isinstance(x, ImageProtocol)):
         if not obj.pixel_spacing:
@@ -313,7 +567,7 @@ def read_layers(*paths, **kwargs):
             if np.issubdtype(obj.data.dtype, np.integer) and np.iinfo(obj.data.dtype).bits == 8:
                 layers.append(read_segmentation(obj))
             else:
-                layers.append(read_image(obj))
+                layers.append(read_image(obj, multiscale=multiscale))
         elif isinstance(obj, PoseSetProtocol):
             layers.extend(read_particles(obj))
 
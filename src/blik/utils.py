@@ -1,25 +1,175 @@
-import einops
+import threading
+from collections import OrderedDict
+
 import napari
 import numpy as np
+import pandas as pd
 from scipy.spatial.transform import Rotation
 
+# orientations are stored as scalar-last quaternions (scipy convention) in plain float columns
+QUAT_COLS = ["quat_x", "quat_y", "quat_z", "quat_w"]
+IDENTITY_QUAT = np.array([0, 0, 0, 1], dtype=float)
+# above this many particles, only a subset of orientations is displayed as vectors
+MAX_DISPLAYED_ORIENTATIONS = 100_000
+# vector colors of the most recently used particle counts are kept up to this size
+VECTOR_COLORS_CACHE_MAX_BYTES = 2**27
+
+_vector_colors = OrderedDict()
+_vector_colors_lock = threading.Lock()
+
 
 def invert_xyz(arr):
     return arr[..., ::-1]
 
 
-def generate_vectors(coords, orientations):
-    """Generate basis vectors and relative colors for napari."""
-    mat = Rotation.concatenate(orientations).as_matrix()
-    basis_vecs = einops.rearrange(mat, "batch a b -> b batch a")
-    vec_data = np.empty((len(coords) * 3, 2, 3))
-    vec_color = np.empty((len(coords) * 3, 3))
-    for idx, vecs in enumerate(basis_vecs):
-        color = np.zeros(3)
-        color[idx] = 1  # rgb
-        vec_data[idx::3] = np.stack([coords, vecs], axis=1)
-        vec_color[idx::3] = color
-    return vec_data, vec_color
+def get_full_resolution(layer):
+    """Data of a layer at full resolution (first level of multiscale layers)."""
+    return layer.data[0] if getattr(layer, "multiscale", False) else layer.data
+
+
+def current_section(viewer, layer):
+    """Index of the section of layer (along its first axis) currently displayed in viewer."""
+    index = int(np.round(layer.world_to_data(viewer.dims.point)[0]))
+    return int(np.clip(index, 0, get_full_resolution(layer).shape[0] - 1))
+
+
+@pd.api.extensions.register_dataframe_accessor("orientation")
+class OrientationAccessor:
+    """
+    Columnar access to particle orientations stored in a features dataframe.
+
+    Orientations live in the `QUAT_COLS` float columns, so no python object is kept per row.
+    Missing values are treated as identity rotations.
+    """
+
+    def __init__(self, df):
+        self._df = df
+
+    @property
+    def available(self):
+        """Whether the dataframe holds any orientation information."""
+        return set(QUAT_COLS).issubset(self._df.columns) or "orientation" in self._df.columns
+
+    @property
+    def quat(self):
+        """(N, 4) float array of quaternions (scalar-last)."""
+        if set(QUAT_COLS).issubset(self._df.columns):
+            quat = self._df[QUAT_COLS].to_numpy(dtype=float)
+        elif "orientation" in self._df.columns:
+            # legacy column of Rotation objects
+            quat = np.array(
+                [IDENTITY_QUAT if pd.isnull(rot) else rot.as_quat() for rot in self._df["orientation"]],
+                dtype=float,
+            ).reshape(-1, 4)
+        else:
+            return np.tile(IDENTITY_QUAT, (len(self._df), 1))
+        missing = np.isnan(quat).any(axis=1)
+        if missing.any():
+            quat = np.where(missing[:, np.newaxis], IDENTITY_QUAT, quat)
+        return quat
+
+    @property
+    def rotation(self):
+        """All orientations as a single scipy Rotation."""
+        if not len(self._df):
+            return Rotation.identity(0)
+        return Rotation.from_quat(self.quat)
+
+    def set(self, orientations, index=None):
+        """
+        Set orientations from a Rotation or an array of quaternions.
+
+        If index is given, only set orientations for those rows (a single orientation is broadcast).
+        """
+        if isinstance(orientations, Rotation):
+            orientations = orientations.as_quat()
+        if not set(QUAT_COLS).issubset(self._df.columns):
+            # migrate legacy or missing orientations to quaternion columns first
+            self._df[QUAT_COLS] = self.quat
+            self._df.drop(columns="orientation", errors="ignore", inplace=True)
+        if index is None:
+            self._df[QUAT_COLS] = np.broadcast_to(orientations, (len(self._df), 4))
+        else:
+            self._df.loc[index, QUAT_COLS] = orientations
+
+
+def orientation_features(orientations):
+    """Create a features dataframe from a Rotation."""
+    return pd.DataFrame(orientations.as_quat().reshape(-1, 4), columns=QUAT_COLS)
+
+
+def generate_vector_colors(n_particles):
+    """Red, green and blue for the x, y and z basis vectors of each particle (cached and read-only)."""
+    with _vector_colors_lock:
+        colors = _vector_colors.pop(n_particles, None)
+        if colors is None:
+            colors = np.tile(np.eye(3), (n_particles, 1))
+            colors.flags.writeable = False
+        _vector_colors[n_particles] = colors
+        total = sum(c.nbytes for c in _vector_colors.values())
+        while total > VECTOR_COLORS_CACHE_MAX_BYTES and len(_vector_colors) > 1:
+            total -= _vector_colors.popitem(last=False)[1].nbytes
+    return colors
+
+
+def generate_vectors(coords, orientations, out=None):
+    """
+    Generate basis vectors and relative colors for napari.
+
+    If an `out` buffer of the right shape is provided, vectors are written in place.
+    Returned colors are cached per particle count and read-only.
+    """
+    mat = orientations.as_matrix().reshape(-1, 3, 3)
+    n_particles = len(mat)
+    if out is None or out.shape != (n_particles * 3, 2, 3):
+        out = np.empty((n_particles * 3, 2, 3))
+    vec_data = out.reshape(n_particles, 3, 2, 3)
+    vec_data[:, :, 0] = np.asarray(coords)[:, np.newaxis]
+    # basis vectors are the columns of the rotation matrices
+    vec_data[:, :, 1] = mat.transpose(0, 2, 1)
+    return out, generate_vector_colors(n_particles)
+
+
+def stratified_subsample(coords, n_samples, seed=0):
+    """
+    Indices (sorted) of a spatially uniform subsample of coords.
+
+    Space is divided in a grid of about n_samples cells; points are picked one per cell
+    (in random order), then a second one per cell, and so on until n_samples are picked.
+    """
+    coords = np.asarray(coords, dtype=float)
+    if len(coords) <= n_samples:
+        return np.arange(len(coords))
+    low = coords.min(axis=0)
+    extent = coords.max(axis=0) - low
+    flat = extent <= 0
+    extent[flat] = 1
+    cell_size = (np.prod(extent[~flat]) / n_samples) ** (1 / max(np.sum(~flat), 1))
+    shape = np.ceil(extent / cell_size).astype(int) + 1
+    cells = np.ravel_multi_index(((coords - low) // cell_size).astype(int).T, shape)
+
+    rng = np.random.default_rng(seed)
+    # shuffle first, so the order within each cell is random
+    shuffled = rng.permutation(len(coords))
+    order = shuffled[np.argsort(cells[shuffled], kind="stable")]
+    sorted_cells = cells[order]
+    cell_start = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    cell_len = np.diff(np.r_[cell_start, len(order)])
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order)) - np.repeat(cell_start, cell_len)
+
+    # take whole "rounds" of one point per cell, and a random part of the last one
+    level = np.searchsorted(np.cumsum(np.bincount(rank)), n_samples)
+    picked = np.flatnonzero(rank < level)
+    last_round = np.flatnonzero(rank == level)
+    picked = np.r_[picked, rng.choice(last_round, n_samples - len(picked), replace=False)]
+    return np.sort(picked)
+
+
+def surface_colormap(colors):
+    """Colormap for a surface layer, made of the unique colors in order of appearance."""
+    uniq_colors, idx = np.unique(colors, axis=0, return_index=True)
+    return uniq_colors[np.argsort(idx)]
 
 
 def layer_tuples_to_layers(layer_tuples):
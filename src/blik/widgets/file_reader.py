@@ -3,6 +3,7 @@ from typing import TYPE_CHECKING, List
 
 from magicgui import magic_factory
 
+from ..cache import clear_particle_cache
 from ..reader import read_layers
 
 if TYPE_CHECKING:
@@ -20,13 +21,26 @@ def file_reader(
     name_regex: List[str],
     names: List[str],
     as_dask_array: bool = True,
+    workers: int = 0,
+    use_cache: bool = True,
+    clear_cache: bool = False,
 ) -> "napari.types.LayerDataTuple":
     """
     Read files with blik.
 
     name_regex: a regex string. Matching text will be used as name for the piece of data
     names: only load data matching this comma separated list of names
+    workers: number of files to read in parallel (0 for automatic)
+    use_cache: reuse particles parsed in previous sessions if the files did not change
+    clear_cache: remove all cached particles before reading
     """
+    if clear_cache:
+        clear_particle_cache()
     return read_layers(
-        *files, name_regex=name_regex or None, names=names or None, lazy=as_dask_array
+        *files,
+        name_regex=name_regex or None,
+        names=names or None,
+        lazy=as_dask_array,
+        workers=workers or None,
+        use_cache=use_cache,
     )
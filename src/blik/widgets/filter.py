@@ -3,30 +3,119 @@ from typing import TYPE_CHECKING
 import numpy as np
 from magicgui import magic_factory
 from scipy.signal.windows import gaussian
-from skimage.filters import butterworth
+
+from ..fft import rfftn
+from ..filters import bandpass_from_fft, gaussian_smooth, iter_bandpass, slab_average
+from ..utils import current_section, get_full_resolution
+from .jobs import add_cancel_button, start_job
 
 if TYPE_CHECKING:
     import napari
 
 
+def _preview_layer_name(image):
+    return f"bandpass preview {image.name}"
+
+
+def _follow_current_step(wdg, viewer):
+    """Update the preview when the displayed section of viewer changes (None to stop following)."""
+    previous = getattr(wdg, "_preview_viewer", None)
+    if previous is viewer:
+        return
+    if previous is not None:
+        previous.dims.events.current_step.disconnect(wdg._on_current_step)
+    if viewer is not None:
+        viewer.dims.events.current_step.connect(wdg._on_current_step)
+    wdg._preview_viewer = viewer
+
+
+def _update_bandpass_preview(wdg):
+    """Bandpass the displayed section (or slab) of the image, reusing its fft if possible."""
+    viewer = wdg.viewer.value
+    image = wdg.image.value
+    # only follow the viewer while previewing
+    _follow_current_step(wdg, viewer if wdg.preview.value else None)
+    if viewer is None:
+        return
+
+    if image is None or not wdg.preview.value:
+        for layer in list(viewer.layers):
+            if layer.name.startswith("bandpass preview "):
+                viewer.layers.remove(layer)
+        wdg._preview_fft = None
+        return
+
+    data = get_full_resolution(image)
+    thickness = wdg.preview_thickness.value
+    index = current_section(viewer, image) if data.ndim > 2 else 0
+    key = (id(data), index, thickness)
+    if getattr(wdg, "_preview_fft", None) is None or wdg._preview_fft[0] != key:
+        section = slab_average(data, index, thickness) if data.ndim > 2 else np.asarray(data, dtype=np.float32)
+        wdg._preview_fft = (key, rfftn(section), section.shape)
+    _, transformed, shape = wdg._preview_fft
+    filtered = bandpass_from_fft(transformed, shape, wdg.low.value, wdg.high.value)
+
+    # show the filtered section in place of the original one
+    translate = np.array(image.translate, dtype=float)
+    if data.ndim > 2:
+        filtered = filtered[np.newaxis]
+        translate[0] += index * image.scale[0]
+    name = _preview_layer_name(image)
+    if name in viewer.layers:
+        layer = viewer.layers[name]
+        layer.data = filtered
+        layer.translate = translate
+        layer.reset_contrast_limits()
+    else:
+        viewer.add_image(filtered, name=name, scale=image.scale, translate=translate)
+
+
+def _init_bandpass_filter(wdg):
+    def _on_current_step(event):
+        _update_bandpass_preview(wdg)
+
+    def _on_destroyed(obj=None):
+        _follow_current_step(wdg, None)
+
+    wdg._on_current_step = _on_current_step
+    wdg.native.destroyed.connect(_on_destroyed)
+    add_cancel_button(wdg)
+    for name in ("image", "low", "high", "preview", "preview_thickness"):
+        getattr(wdg, name).changed.connect(lambda _: _update_bandpass_preview(wdg))
+
+
 @magic_factory(
     auto_call=False,
     call_button=True,
     low={"widget_type": "FloatSlider", "min": 0, "max": 0.5},
     high={"widget_type": "FloatSlider", "min": 0, "max": 0.5},
+    preview_thickness={"min": 1, "max": 99},
+    widget_init=_init_bandpass_filter,
 )
 def bandpass_filter(
+    viewer: "napari.viewer.Viewer",
     image: "napari.layers.Image",
     low: float = 0.1,
     high: float = 0.4,
     is_2D_data: bool = False,
-) -> "napari.types.LayerDataTuple":
-    channel_axis = 0 if is_2D_data else None
-    high_pass = butterworth(
-        np.asarray(image.data), low, high_pass=True, channel_axis=channel_axis
-    )
-    low_pass = butterworth(high_pass, high, channel_axis=channel_axis)
-    return low_pass, {"name": f"filtered {image.name}", "scale": image.scale}, "image"
+    preview: bool = False,
+    preview_thickness: int = 1,
+) -> "napari.qt.threading.FunctionWorker[napari.types.LayerDataTuple]":
+    """
+    Butterworth bandpass filter between low and high (in cycles/pixel, 0 to disable).
+
+    Lazy (dask) images are filtered lazily, slab by slab; others are filtered in the background
+    (which can be cancelled between steps).
+    preview: live 2D filtering of the displayed section, averaged over preview_thickness sections
+    """
+    data = get_full_resolution(image)
+    attributes = {"name": f"filtered {image.name}", "scale": image.scale}
+
+    def _bandpass():
+        filtered = yield from iter_bandpass(data, low, high, is_2D_data=is_2D_data)
+        return filtered, attributes, "image"
+
+    return start_job("bandpass_filter", _bandpass, key=image.name, desc=f"bandpass filtering {image.name}")
 
 
 def gaussian_kernel(size, sigma):
@@ -39,11 +128,31 @@ def gaussian_kernel(size, sigma):
     auto_call=True,
     sigma={"widget_type": "FloatSlider", "min": 0.1, "max": 5, "step": 0.1},
     kernel_size={"widget_type": "Slider", "min": 3, "max": 20},
+    mode={"choices": ["interpolation kernel", "smoothed layer"]},
 )
 def gaussian_filter(
     image: "napari.layers.Image",
     sigma: float = 1,
     kernel_size: int = 3,
-) -> None:
-    image.interpolation2d = "custom"
-    image.custom_interpolation_kernel_2d = gaussian_kernel(kernel_size, sigma)
+    mode: str = "interpolation kernel",
+    is_2D_data: bool = False,
+) -> "napari.types.LayerDataTuple":
+    """
+    Gaussian smoothing of the image.
+
+    mode: "interpolation kernel" only changes how the image is displayed (in 2D);
+        "smoothed layer" adds a smoothed copy of the image (lazy for lazy images),
+        which is cached, so going back to a previous sigma is instant
+    """
+    if mode == "interpolation kernel":
+        image.interpolation2d = "custom"
+        image.custom_interpolation_kernel_2d = gaussian_kernel(kernel_size, sigma)
+        return None
+
+    data = get_full_resolution(image)
+    sigmas = (0,) * (data.ndim - 2) + (sigma,) * 2 if is_2D_data else sigma
+    return (
+        gaussian_smooth(data, sigmas),
+        {"name": f"smoothed {image.name}", "scale": image.scale, "translate": image.translate},
+        "image",
+    )
@@ -0,0 +1,38 @@
+from magicgui.widgets import PushButton
+from napari.qt.threading import thread_worker
+
+# running workers, by job name (the name of the widget starting them) and key
+_JOBS = {}
+
+
+def start_job(name, func, *args, key=None, total=0, desc=None, **kwargs):
+    """
+    Run func(*args, **kwargs) in a background thread worker, and return the (started) worker.
+
+    Generator functions report progress each time they yield (expecting `total` yields)
+    and can be cancelled at any yield with cancel_jobs (e.g. from a widget's cancel button).
+    Jobs with the same name and key (e.g. an experiment id) cannot run at the same time,
+    while jobs with different keys run concurrently.
+    """
+    if (name, key) in _JOBS:
+        raise RuntimeError(f"{name} is already running for {key}")
+    worker = thread_worker(func, progress={"total": total, "desc": desc or f"{name} ({key})"})(*args, **kwargs)
+    _JOBS[name, key] = worker
+    worker.finished.connect(lambda: _JOBS.pop((name, key), None))
+    worker.start()
+    return worker
+
+
+def cancel_jobs(name):
+    """Cancel all running jobs with this name (at their next progress step)."""
+    for (job_name, _), worker in list(_JOBS.items()):
+        if job_name == name:
+            worker.quit()
+
+
+def add_cancel_button(wdg):
+    """Add a button cancelling the running jobs started by the widget, and return the widget."""
+    button = PushButton(text="Cancel", gui_only=True)
+    button.changed.connect(lambda: cancel_jobs(wdg.name))
+    wdg.append(button)
+    return wdg
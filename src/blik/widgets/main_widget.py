@@ -1,20 +1,39 @@
 from __future__ import annotations
 
+import pathlib
 from importlib.metadata import version
+from weakref import WeakKeyDictionary, ref
 
 import napari
 import numpy as np
-import pandas as pd
 from magicgui import magic_factory, magicgui
 from magicgui.widgets import Container
 from napari.layers import Image, Labels, Points, Shapes, Vectors
+from napari.qt.threading import thread_worker
 from napari.utils._magicgui import find_viewer_ancestor
 from napari.utils.notifications import show_info
 from packaging.version import parse as parse_version
+from qtpy.QtCore import QTimer
+from qtpy.QtWidgets import QApplication
 from scipy.spatial.transform import Rotation
 
+from ..cache import release_volume
 from ..reader import construct_particle_layer_tuples, construct_segmentation_layer_tuple
-from ..utils import generate_vectors, invert_xyz, layer_tuples_to_layers
+from ..utils import (
+    MAX_DISPLAYED_ORIENTATIONS,
+    generate_vector_colors,
+    generate_vectors,
+    get_full_resolution,
+    invert_xyz,
+    layer_tuples_to_layers,
+    stratified_subsample,
+)
+from ..writer import PARTICLE_WRITERS, export_tasks, iter_export_experiments
+
+# bursts of points events are coalesced into at most one vectors update per interval (~1 frame)
+VECTORS_UPDATE_INTERVAL_MS = 16
+# when only part of the orientations is displayed in 2D, show those this close to the slice
+ORIENTATIONS_SLICE_MARGIN_A = 100
 
 
 def _get_choices(wdg, condition=None):
@@ -36,27 +55,240 @@ def _get_choices(wdg, condition=None):
     return sorted(choices)
 
 
-def _connect_points_to_vectors(p, v):
-    """connect a particle points layer to a vectors layer to keep them in sync."""
+class _PointsVectorsSync:
+    """
+    Keep a vectors layer in sync with the positions and orientations of a particle points layer.
+
+    Positions and orientations from the last sync are cached, so only the arrows of particles
+    that were added, removed, moved or rotated are recomputed. When a Qt application is running,
+    bursts of events are coalesced into a single update every `VECTORS_UPDATE_INTERVAL_MS`.
+
+    Above `MAX_DISPLAYED_ORIENTATIONS` particles, only a subset of the arrows is displayed:
+    those close to the current slice in 2D, spatially subsampled if still too many.
+    The subset is refined when the slice or view changes.
 
-    def _update_vectors():
-        if not len(p.data):
+    Layers and viewer are only weakly referenced, so deleted layers can be garbage collected.
+    """
+
+    def __init__(self, p, v, viewer=None):
+        self._points = ref(p)
+        self._vectors = ref(v)
+        self._viewer = (lambda: None) if viewer is None else ref(viewer)
+        self._resized = False
+        self._view_changed = False
+        self._shown = None  # indices of particles whose vectors are displayed (None for all)
+        self._timer = None
+        self.rebuild()
+
+    @property
+    def points(self):
+        return self._points()
+
+    @property
+    def vectors(self):
+        return self._vectors()
+
+    @property
+    def viewer(self):
+        return self._viewer()
+
+    @property
+    def alive(self):
+        """Whether both layers still exist."""
+        return self.points is not None and self.vectors is not None
+
+    def _view_events(self):
+        if self.viewer is None:
+            return []
+        dims = self.viewer.dims.events
+        return [dims.point, dims.thickness, dims.ndisplay, dims.order]
+
+    def connect(self):
+        self.points.events.data.connect(self._on_data)
+        self.points.events.features.connect(self.schedule)
+        for ev in self._view_events():
+            ev.connect(self._on_view_change)
+
+    def disconnect(self):
+        if self.points is not None:
+            self.points.events.data.disconnect(self._on_data)
+            self.points.events.features.disconnect(self.schedule)
+        for ev in self._view_events():
+            ev.disconnect(self._on_view_change)
+        if self._timer is not None:
+            self._timer.stop()
+
+    def schedule(self, event=None):
+        """Request a sync, which will happen at the end of the current burst of events."""
+        if QApplication.instance() is None:
+            # no event loop to defer to (e.g: scripting without gui)
+            self.sync()
             return
-        if np.any(pd.isnull(p.features["orientation"])):
-            obj = p.features["orientation"].astype(object)
-            obj[pd.isnull(obj)] = Rotation.identity()
-            p.features["orientation"] = obj
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.setInterval(VECTORS_UPDATE_INTERVAL_MS)
+            self._timer.timeout.connect(self.sync)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """Apply a pending sync right away."""
+        if self._timer is not None and self._timer.isActive():
+            self._timer.stop()
+            self.sync()
+
+    def rebuild(self):
+        """Regenerate all vectors from scratch."""
+        self._pos = np.array(self.points.data, dtype=float).reshape(-1, 3)
+        self._quat = np.array(self.points.features.orientation.quat)
+        # reuse the previous buffer, unless the vectors layer displays it (it would change
+        # under napari's feet) or the number of particles changed (checked by generate_vectors)
+        out = getattr(self, "_vec", None)
+        if out is not None and np.shares_memory(out, self.vectors.data):
+            out = None
         # invert xyz and zyx back and forth because calculation happens in xyz space
-        vec_data, vec_color = generate_vectors(
-            invert_xyz(p.data), p.features["orientation"]
+        self._vec, _ = generate_vectors(invert_xyz(self._pos), Rotation.from_quat(self._quat.reshape(-1, 4)), out=out)
+        self._display()
+
+    def _select_shown(self):
+        """Choose which particles should have their vectors displayed."""
+        n_particles = len(self._pos)
+        if self.viewer is None or n_particles <= MAX_DISPLAYED_ORIENTATIONS:
+            return None
+        candidates = np.arange(n_particles)
+        dims = self.viewer.dims
+        if dims.ndisplay == 2:
+            world = self._pos * self.points.scale + self.points.translate
+            axis_offset = dims.ndim - world.shape[1]
+            in_slice = np.ones(n_particles, dtype=bool)
+            for axis in dims.not_displayed:
+                if axis < axis_offset:
+                    continue
+                half_width = dims.thickness[axis] / 2 + ORIENTATIONS_SLICE_MARGIN_A
+                in_slice &= np.abs(world[:, axis - axis_offset] - dims.point[axis]) <= half_width
+            candidates = np.flatnonzero(in_slice)
+        subsample = stratified_subsample(self._pos[candidates], MAX_DISPLAYED_ORIENTATIONS)
+        return candidates[subsample]
+
+    def _display(self):
+        """Push the (subset of) vectors to the vectors layer."""
+        self._shown = self._select_shown()
+        vec = self._vec
+        if self._shown is not None:
+            vec = vec.reshape(-1, 3, 2, 3)[self._shown].reshape(-1, 2, 3)
+        self.vectors.data = invert_xyz(vec)
+        self.vectors.edge_color = generate_vector_colors(len(vec) // 3)
+        self._resized = False
+        self._view_changed = False
+
+    def _on_data(self, event):
+        # removals cannot be inferred by comparing with the cache, so we drop rows right away
+        if event.action != "removed" or not len(event.data_indices):
+            return
+        removed = np.asarray(event.data_indices)
+        keep = np.ones(len(self._pos), dtype=bool)
+        # points added and removed within the same burst were never cached
+        keep[removed[removed < len(keep)]] = False
+        self._pos = self._pos[keep]
+        self._quat = self._quat[keep]
+        self._vec = self._vec.reshape(-1, 3, 2, 3)[keep].reshape(-1, 2, 3)
+        self._resized = True
+
+    def _on_view_change(self, event=None):
+        if self._shown is None and len(self._pos) <= MAX_DISPLAYED_ORIENTATIONS:
+            return
+        self._view_changed = True
+        self.schedule()
+
+    def sync(self, event=None):
+        """Patch the vectors of all the particles that changed since the last sync."""
+        if not self.alive:
+            return
+        pos = np.asarray(self.points.data, dtype=float).reshape(-1, 3)
+        quat = self.points.features.orientation.quat
+        n_old = len(self._pos)
+        n_new = len(pos)
+        if n_new < n_old or len(quat) != n_new:
+            # points removed without us knowing which ones, or features not in sync yet
+            self.rebuild()
+            return
+
+        changed = np.ones(n_new, dtype=bool)  # added points are always appended
+        changed[:n_old] = np.any(pos[:n_old] != self._pos, axis=1) | np.any(
+            quat[:n_old] != self._quat, axis=1
+        )
+        resized = self._resized or n_new != n_old
+        if not changed.any() and not resized and not self._view_changed:
+            return
+
+        if n_new != n_old:
+            self._pos = np.concatenate([self._pos, pos[n_old:]])
+            self._quat = np.concatenate([self._quat, quat[n_old:]])
+            self._vec = np.concatenate([self._vec, np.empty(((n_new - n_old) * 3, 2, 3))])
+        self._pos[changed] = pos[changed]
+        self._quat[changed] = quat[changed]
+        patch, _ = generate_vectors(
+            invert_xyz(pos[changed]), Rotation.from_quat(quat[changed].reshape(-1, 4))
         )
-        v.data = invert_xyz(vec_data)
-        v.edge_color = vec_color
+        self._vec.reshape(-1, 3, 2, 3)[changed] = patch.reshape(-1, 3, 2, 3)
+
+        if resized or self._view_changed:
+            self._display()
+            return
+
+        # patch in place and only refresh the slice (like napari does when moving points)
+        # to avoid the data setter, which recomputes extent and thumbnail on all vectors
+        changed_idx = np.flatnonzero(changed)
+        patch = patch.reshape(-1, 3, 2, 3)
+        if self._shown is not None:
+            # only patch particles that are currently displayed (possibly none of them)
+            displayed = np.isin(changed_idx, self._shown)
+            if not displayed.any():
+                return
+            changed_idx = np.searchsorted(self._shown, changed_idx[displayed])
+            patch = patch[displayed]
+        rows = (changed_idx[:, np.newaxis] * 3 + np.arange(3)).ravel()
+        self.vectors.data[rows] = invert_xyz(patch.reshape(-1, 2, 3))
+        self.vectors.refresh(thumbnail=False, extent=False)
+
+
+# points layer -> sync object, so we do not connect the same pair multiple times
+_synced_layers = WeakKeyDictionary()
 
-    p.events.set_data.disconnect(_update_vectors)
-    p.events.set_data.connect(_update_vectors)
-    p.events.features.disconnect(_update_vectors)
-    p.events.features.connect(_update_vectors)
+
+def _connect_points_to_vectors(p, v, viewer=None):
+    """connect a particle points layer to a vectors layer to keep them in sync."""
+    sync = _synced_layers.get(p, None)
+    if sync is not None:
+        if sync.vectors is v and sync.viewer is viewer:
+            return
+        # vectors layer was replaced
+        sync.disconnect()
+    sync = _PointsVectorsSync(p, v, viewer=viewer)
+    sync.connect()
+    _synced_layers[p] = sync
+
+
+def _disconnect_removed_layer(e):
+    """Stop syncing particles whose points or vectors layer was removed from the viewer."""
+    for p, sync in list(_synced_layers.items()):
+        if e.value is p or e.value is sync.vectors:
+            sync.disconnect()
+            _synced_layers.pop(p, None)
+
+
+def _release_removed_layer(e):
+    """Drop the cached volume of a removed layer (napari may keep the layer alive for a while)."""
+    if isinstance(e.value, (Image, Labels)):
+        release_volume(get_full_resolution(e.value))
+
+
+def flush_vectors_updates():
+    """Immediately apply all pending updates of vectors layers (useful when scripting)."""
+    for sync in list(_synced_layers.values()):
+        if sync.alive:
+            sync.flush()
 
 
 def _connect_picking_callbacks(surf):
@@ -74,6 +306,8 @@ def _attach_callbacks_to_viewer(wdg):
     viewer = find_viewer_ancestor(wdg.native)
     if viewer:
         viewer.layers.events.inserted.connect(lambda e: _connect_layers(viewer, e))
+        viewer.layers.events.removed.connect(_disconnect_removed_layer)
+        viewer.layers.events.removed.connect(_release_removed_layer)
         _connect_layers(viewer, None)
 
         # pixels are 1 A. We put 0.1nm cause it's more readable with multiples
@@ -102,7 +336,7 @@ def _connect_layers(viewer, e):
     for p_id, p in points.items():
         v = vectors.get(p_id, None)
         if v is not None:
-            _connect_points_to_vectors(p, v)
+            _connect_points_to_vectors(p, v, viewer=viewer)
 
 
 @magic_factory(
@@ -178,7 +412,7 @@ def new(
         for lay in layers:
             if isinstance(lay, Image) and lay.metadata["experiment_id"] == exp_id:
                 layer = construct_segmentation_layer_tuple(
-                    data=np.zeros(lay.data.shape, dtype=np.int32),
+                    data=np.zeros(get_full_resolution(lay).shape, dtype=np.int32),
                     scale=lay.scale[0],
                     exp_id=exp_id,
                     stack=lay.metadata["stack"],
@@ -256,13 +490,56 @@ def slice_thickness_A(viewer: napari.Viewer, thickness_A=0):
     viewer.dims.thickness = (thickness_A,) * viewer.dims.ndim
 
 
+def _layer_snapshot(layer):
+    """Layer data tuple of the layer, copying data that can still be edited while it is exported."""
+    data, state, layer_type = layer.as_layer_data_tuple()
+    if isinstance(layer, (Labels, Points, Shapes)):
+        if isinstance(data, list):
+            data = [d.copy() if isinstance(d, np.ndarray) else d for d in data]
+        elif isinstance(data, np.ndarray):
+            data = data.copy()
+        if "features" in state:
+            state["features"] = state["features"].copy()
+    return data, state, layer_type
+
+
+@magicgui(
+    labels=False,
+    call_button="Export all",
+    directory={"mode": "d"},
+    particles_format={"choices": list(PARTICLE_WRITERS)},
+)
+def export_all(viewer: napari.Viewer, directory: pathlib.Path, particles_format="relion_40", workers: int = 0):
+    """
+    Write all experiments to directory, one subdirectory per experiment_id.
+
+    Files are written concurrently in the background (0 workers for an automatic amount).
+    """
+    if directory is None or pathlib.Path(directory) == pathlib.Path():
+        show_info("choose a directory to export to")
+        return
+    # take the layer data here, so layers are not accessed from other threads
+    layer_data = [_layer_snapshot(lay) for lay in viewer.layers]
+    n_files = len(export_tasks(layer_data, directory, particles_format))
+    if not n_files:
+        show_info("no layers with blik metadata to export")
+        return
+
+    worker = thread_worker(
+        iter_export_experiments,
+        progress={"total": n_files, "desc": "exporting experiments"},
+    )(layer_data, directory, particles_format, workers or None)
+    worker.returned.connect(lambda _: show_info(f"exported {n_files} files to {directory}"))
+    worker.start()
+
+
 class MainBlikWidget(Container):
     """
     Main widget for blik controls.
 
     Allows to select which layers to view based on the experiment id, to add
-    existing layer to a certain experiment id, and to create new analysis layers
-    within.
+    existing layer to a certain experiment id, to create new analysis layers
+    within, and to export all experiments at once.
     """
 
     def __init__(self, *args, **kwargs):
@@ -273,6 +550,7 @@ class MainBlikWidget(Container):
         self.append(exp)
         self.append(new)
         self.append(add_to_exp)
+        self.append(export_all)
         if parse_version(version("napari")) >= parse_version("0.5.0a"):
             self.append(slice_thickness_A)
 
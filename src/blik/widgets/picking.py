@@ -1,42 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
 import napari
 import numpy as np
 import pandas as pd
-from dask.array import compute
 from magicgui import magic_factory, magicgui
 from magicgui.widgets import Container
 from morphosamplers.helical_filament import HelicalFilament
 from morphosamplers.models import Sphere
-from morphosamplers.preprocess import get_label_paths_3d
+from morphosamplers.preprocess import connect_paths, dist_dijkstra, get_label_paths_2d
 from morphosamplers.sampler import (
-    sample_volume_along_spline,
-    sample_volume_around_surface,
+    generate_1d_grid,
+    generate_2d_grid,
+    place_sampling_grids,
+    sample_volume_at_coordinates,
 )
 from morphosamplers.samplers.sphere_samplers import PointSampler, PoseSampler
 from morphosamplers.surface_spline import GriddedSplineSurface
+from napari.qt.threading import FunctionWorker
+from napari.utils.notifications import show_info
+from scipy.ndimage import find_objects
 from scipy.spatial import ConvexHull
 from scipy.spatial.transform import Rotation
-
-from ..reader import construct_particle_layer_tuples
-from ..utils import invert_xyz
-
-
-def _generate_surface_grids_from_shapes_layer(
-    surface_shapes,
-    spacing_A=100,
-    inside_points=None,
-    closed=False,
-):
-    """create a new surface representation from picked surface points."""
-    spacing_A /= surface_shapes.scale[0]
-    colors = []
-    surface_grids = []
+from skimage.measure import label as label_components
+
+from ..cache import materialized
+from ..reader import construct_particle_layer_tuples, read_mrc
+from ..utils import (
+    get_full_resolution,
+    invert_xyz,
+    orientation_features,
+    surface_colormap,
+)
+from ..writer import _safe_filename, write_image
+from .jobs import add_cancel_button, start_job
+
+# sub-volumes loaded for resampling extend this many voxels beyond the sampled coordinates,
+# so the cubic spline prefilter is not affected by the crop
+RESAMPLE_CROP_PADDING = 8
+# filaments are resampled this many positions at a time, so the job can be cancelled in between
+RESAMPLE_FILAMENT_STEP = 64
+# parameters needed to rebuild a GriddedSplineSurface (stored in surface layer metadata)
+SURFACE_GRID_FIELDS = ("points", "separation", "order", "smoothing", "closed", "inside_point", "oversampling")
+# where resampled volumes go: kept in memory and shown in a new viewer, or written to mrc files
+# (optionally opened lazily in the current viewer, for bounded memory use)
+RESAMPLE_OUTPUTS = ("new viewer", "current viewer (lazy)", "mrc files")
+
+
+def _inside_point(inside_points):
+    """Inside point (in xyz) from a points layer, if any."""
+    if inside_points is None or not len(inside_points.data):
+        return None
+    return invert_xyz(inside_points.data[0])
+
+
+def _surface_lines_from_shapes_layer(surface_shapes):
+    """Lines (in xyz) and colors of each surface picked in a shapes layer."""
+    surfaces = []
     data_array = np.array(surface_shapes.data, dtype=object)  # helps with indexing
-    if inside_points is None:
-        inside_point = None
-    else:
-        inside_point = (
-            invert_xyz(inside_points.data[0]) if len(inside_points.data) else None
-        )
     for _, surf in surface_shapes.features.groupby("surface_id"):
         lines = data_array[surf.index]
         # sort by z so lines can be added in between at a later point
@@ -45,84 +67,245 @@ def _generate_surface_grids_from_shapes_layer(
             invert_xyz(line.astype(float))
             for line in sorted(lines, key=lambda x: x[0, 0])
         ]
-
-        # drop duplicate points (messes up scipy's fitpack for splines)
-        lines = [pd.DataFrame(line).drop_duplicates().to_numpy() for line in lines]
-
-        try:
-            surface_grids.append(
-                GriddedSplineSurface(
-                    points=lines,
-                    separation=spacing_A,
-                    order=3,
-                    closed=closed,
-                    inside_point=inside_point,
-                )
-            )
-        except ValueError:
+        surfaces.append((lines, surface_shapes.edge_color[surf.index]))
+    return surfaces
+
+
+def _surface_lines_from_labels(labels, slicing_step=10, sampling_step=10, workers=None):
+    """
+    Yield the lines (in xyz) of each surface in a segmentation, one per connected object of each label value.
+
+    Like morphosamplers' get_label_paths_3d, but each object is processed only within its
+    bounding box, and its sections (every slicing_step along z) are traced concurrently
+    by the given number of workers (see _map_ordered).
+    """
+    # like get_label_paths_3d, touching objects with different label values stay separate
+    components = label_components(materialized(labels))
+    for index, bbox in enumerate(find_objects(components)):
+        if bbox is None:
             continue
+        mask = components[bbox] == index + 1
+        # same sections as if the whole volume was sliced
+        z_indices = range(-bbox[0].start % slicing_step, mask.shape[0], slicing_step)
+        section_paths = _map_ordered(
+            partial(get_label_paths_2d, sampling_step=sampling_step), [mask[z] for z in z_indices], workers
+        )
+        offset = np.array([sl.start for sl in bbox], dtype=float)
+        lines = []
+        for z, paths in zip(z_indices, section_paths):
+            if paths:
+                paths = [np.pad(path, ((0, 0), (1, 0)), constant_values=z) for path in paths]
+                # pieces of the same section are joined along the shortest path inside the object
+                line = connect_paths(paths, partial(dist_dijkstra, field=mask))
+                lines.append(invert_xyz(line + offset))
+        yield lines
 
-        colors.append(surface_shapes.edge_color[surf.index])
 
-    if not colors:
-        raise RuntimeError("could not generate surfaces for some reason")
+def _label_color(index):
+    """Color (1, 3) of the surface of the index-th segmented object, always the same for each index."""
+    return np.random.default_rng(index).random((1, 3))
+
 
-    colors = np.concatenate(colors)
-    return surface_grids, colors
+def _surface_grid(lines, spacing, closed=False, inside_point=None):
+    """Fit a surface grid through lines, or return None if it cannot be done."""
+    # drop duplicate points (messes up scipy's fitpack for splines)
+    lines = [pd.DataFrame(line).drop_duplicates().to_numpy() for line in lines]
+    try:
+        return GriddedSplineSurface(
+            points=lines,
+            separation=spacing,
+            order=3,
+            closed=closed,
+            inside_point=inside_point,
+        )
+    except ValueError:
+        return None
 
 
-def _generate_surface_grids_from_labels_layer(
-    surface_label,
-    spacing_A=100,
-    inside_points=None,
-    closed=False,
+def _map_ordered(func, items, workers=None):
+    """
+    Yield func(item) for each item, in order, computing them concurrently in a thread pool.
+
+    Threads share the (possibly memory-mapped) volumes without copies, and the heavy lifting
+    (spline evaluation, interpolation) is done by numpy and scipy without holding the GIL.
+    workers: number of threads (None for an automatic amount, 1 to run sequentially).
+    """
+    if workers == 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # closing this generator (e.g. when cancelled) cancels the pending items
+        yield from pool.map(func, items)
+
+
+def _fit_and_mesh(lines, spacing, closed=False, inside_point=None):
+    """Surface grid fit through lines and its mesh, or None if it cannot be done."""
+    surf = _surface_grid(lines, spacing, closed, inside_point)
+    if surf is None:
+        return None
+    return surf, surf.mesh()
+
+
+def _surface_layer_tuple(surface_grids, meshes, colors, exp_id, scale):
+    offset = 0
+    vert = []
+    faces = []
+    ids = []
+    for surf_id, (v, f) in enumerate(meshes):
+        f += offset
+        offset += len(v)
+        vert.append(v)
+        faces.append(f)
+        ids.append(np.full(len(v), surf_id))
+    vert = np.concatenate(vert)
+    faces = np.concatenate(faces)
+    colormap = surface_colormap(colors)
+    values = np.concatenate(ids) / len(colormap)
+    # special case for colormap with 1 color because blacks get autoadded at index 0
+    if colormap.shape[0] == 1:
+        values += 1
+
+    # invert_xyz to go back to napari world (also invert faces order to preserve normals)
+    return (
+        (invert_xyz(vert), invert_xyz(faces), values),
+        {
+            "name": f"{exp_id} - surface",
+            "metadata": {
+                "experiment_id": exp_id,
+                "surface_params": [_surface_grid_params(surf) for surf in surface_grids],
+                "surface_colors": colors,
+            },
+            "scale": scale,
+            "shading": "smooth",
+            "colormap": colormap,
+        },
+        "surface",
+    )
+
+
+def _generate_surfaces(
+    exp_id,
+    scale,
+    spacing,
+    closed,
+    inside_point,
+    surfaces=None,
+    labels=None,
+    slicing_step=10,
+    sampling_step=10,
+    workers=None,
 ):
-    """create a new surface representation from a segmentation."""
-    spacing_A /= surface_label.scale[0]
-    surface_grids = []
-    if inside_points is None:
-        inside_point = None
-    else:
-        inside_point = (
-            invert_xyz(inside_points.data[0]) if len(inside_points.data) else None
-        )
+    """
+    Fit and mesh surfaces picked as lines (surfaces) or segmented (labels), yielding after each step.
+
+    Surfaces (and sections of segmented objects) are processed concurrently by the given
+    number of workers (see _map_ordered).
+
+    Returns the surface layer tuples.
+    """
+    if labels is not None:
+        surfaces = []
+        for i, lines in enumerate(_surface_lines_from_labels(labels, slicing_step, sampling_step, workers)):
+            surfaces.append((lines, _label_color(i)))
+            yield
 
-    # doing this "custom" because we need to flip xyz
-    surfaces_lines = get_label_paths_3d(
-        compute(surface_label.data)[0], axis=0, slicing_step=10, sampling_step=10
+    surface_grids = []
+    meshes = []
+    colors = []
+    fits = _map_ordered(
+        lambda lines: _fit_and_mesh(lines, spacing, closed, inside_point),
+        [lines for lines, _ in surfaces],
+        workers,
     )
+    for (_, color), fit in zip(surfaces, fits):
+        if fit is not None:
+            surface_grids.append(fit[0])
+            meshes.append(fit[1])
+            colors.append(color)
+        yield
+
+    if not colors:
+        raise RuntimeError("could not generate surfaces for some reason")
+
+    return [_surface_layer_tuple(surface_grids, meshes, np.concatenate(colors), exp_id, scale)]
+
+
+def _surface_grid_params(surface_grid):
+    """Plain parameters of a surface grid, enough to rebuild it without pickling."""
+    return {field: getattr(surface_grid, field) for field in SURFACE_GRID_FIELDS}
 
-    for lines in surfaces_lines:
-        lines = [invert_xyz(line.astype(float)) for line in lines]
-
-        try:
-            surface_grids.append(
-                GriddedSplineSurface(
-                    points=lines,
-                    separation=spacing_A,
-                    order=3,
-                    closed=closed,
-                    inside_point=inside_point,
-                )
-            )
-        except ValueError:
-            continue
 
-    return surface_grids, np.random.rand(len(surface_grids), 3)
+def _get_surface_params(surface_layer):
+    """Surface grid parameters stored in a surface layer."""
+    params = surface_layer.metadata.get("surface_params", None)
+    if params is None:
+        raise ValueError("This surface layer contains no surface grid parameters.")
+    return params
 
 
-def _resample_surfaces(image_layer, surface_grids, spacing, thickness, masked):
+def _surface_grids_from_params(params, spacing=None):
+    """Rebuild surface grids from their parameters, optionally with a new spacing."""
+    surface_grids = []
+    for p in params:
+        if spacing is not None:
+            p = {**p, "separation": spacing}
+        surface_grids.append(GriddedSplineSurface(**p))
+    return surface_grids
+
+
+def _get_surface_grids(surface_layer, spacing=None):
+    """Rebuild the surface grids of a surface layer, optionally with a new spacing."""
+    return _surface_grids_from_params(_get_surface_params(surface_layer), spacing)
+
+
+def _sample_cropped(image_data, coords, interpolation_order=3):
+    """
+    Sample image data (zyx) at coords (xyz, as made by place_sampling_grids).
+
+    Only the padded bounding box of the coordinates is loaded from image data, so memory use
+    and reads scale with the size of the sampled object rather than with the whole volume.
+    """
+    flat = coords.reshape(-1, 3)
+    shape = np.array(image_data.shape[::-1])
+    start = np.clip(np.floor(flat.min(axis=0)).astype(int) - RESAMPLE_CROP_PADDING, 0, shape)
+    stop = np.clip(np.ceil(flat.max(axis=0)).astype(int) + RESAMPLE_CROP_PADDING + 1, 0, shape)
+    if np.any(stop <= start):
+        # nothing to sample, it's all outside the volume
+        return np.full((coords.shape[0], *coords.shape[1:-1]), np.nan)
+    region = tuple(slice(lo, hi) for lo, hi in zip(start[::-1], stop[::-1]))
+    # transposed view to go back to xyz world (no copy)
+    subvolume = materialized(image_data, region).T
+    return sample_volume_at_coordinates(subvolume, coords - start, interpolation_order=interpolation_order)
+
+
+def _resample_surface(image_data, surf, spacing, thickness, masked):
+    """Like morphosamplers' sample_volume_around_surface, but loading only the needed sub-volume."""
+    grid = generate_1d_grid(grid_shape=thickness, grid_spacing=spacing)
+    coords = place_sampling_grids(grid, surf.sample(), surf.sample_orientations())
+    sampled = _sample_cropped(image_data, coords)
+    if masked:
+        sampled[~surf.mask] = np.nan
+    return sampled.reshape(*surf.grid_shape, thickness)
+
+
+def _resample_surfaces(image_data, surface_params, spacing, thickness, masked, workers=None, store=None):
+    """
+    Resample image data around each surface, yielding after each one; returns the volumes.
+
+    Surfaces are resampled concurrently by the given number of workers (see _map_ordered).
+    If given, store(index, volume) is called on each volume as soon as it is done, and its
+    result is returned instead of the volume (e.g. to write it to disk and free the memory).
+    """
+
+    def resample(item):
+        index, surf = item
+        vol = _resample_surface(image_data, surf, spacing, thickness, masked)
+        return vol if store is None else store(index, vol)
+
     volumes = []
-    for surf in surface_grids:
-        vol = sample_volume_around_surface(
-            compute(image_layer.data)[0].T,  # transpose to go back to xyz world
-            surface=surf,
-            sampling_thickness=thickness,
-            sampling_spacing=spacing,
-            interpolation_order=3,
-            masked=masked,
-        )
+    for vol in _map_ordered(resample, enumerate(_surface_grids_from_params(surface_params, spacing)), workers):
         volumes.append(vol)
+        yield
     return volumes
 
 
@@ -135,13 +318,86 @@ def _generate_filaments_from_points_layer(filament_picks):
     return HelicalFilament(points=points)
 
 
-def _resample_filament(image_layer, filament, spacing, thickness):
-    return sample_volume_along_spline(
-        compute(image_layer.data)[0].T,  # transpose to go back to xyz world
-        spline=filament,
-        sampling_shape=(thickness, thickness),
-        sampling_spacing=spacing,
-        interpolation_order=3,
+def _resample_filament(image_data, filament, spacing, thickness, store=None):
+    """
+    Like morphosamplers' sample_volume_along_spline, but loading only the needed sub-volumes.
+
+    The filament is resampled RESAMPLE_FILAMENT_STEP positions at a time, yielding after each.
+    If given, the result of store(0, volume) is returned instead of the volume.
+    """
+    grid = generate_2d_grid(grid_shape=(thickness, thickness), grid_spacing=(spacing, spacing))
+    positions = filament.sample(separation=spacing)
+    orientations = filament.sample_orientations(separation=spacing)
+    pieces = []
+    for start in range(0, len(positions), RESAMPLE_FILAMENT_STEP):
+        piece = slice(start, start + RESAMPLE_FILAMENT_STEP)
+        coords = place_sampling_grids(grid, positions[piece], orientations[piece])
+        pieces.append(_sample_cropped(image_data, coords))
+        yield
+    vol = np.concatenate(pieces)
+    return vol if store is None else store(0, vol)
+
+
+def _resampled_writer(directory, names, exp_id, scale):
+    """
+    Store function for resampling, writing each volume to an mrc file and returning its path.
+
+    Files go in a subdirectory per experiment, and are named after the resampled layers.
+    """
+    if directory is None or Path(directory) == Path():
+        raise ValueError("choose a directory to write the resampled volumes to")
+    directory = Path(directory) / _safe_filename(exp_id)
+    attributes = {"metadata": {"experiment_id": exp_id, "stack": False}, "scale": scale}
+
+    def store(index, volume):
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{_safe_filename(names[index])}.mrc"
+        return write_image(path, volume, attributes, dtype=np.float32)[0]
+
+    return store
+
+
+def _show_resampled(results, names, exp_id, scale, output="new viewer", viewer=None):
+    """Show resampled volumes in a new viewer, or the mrc files they were written to (see RESAMPLE_OUTPUTS)."""
+    if not len(results):
+        show_info(f"nothing to resample for {exp_id}")
+        return
+    if output == "mrc files":
+        show_info(f"wrote {len(results)} resampled volumes to {Path(results[0]).parent}")
+        return
+    if output == "new viewer":
+        viewer = napari.Viewer()
+    for res, name in zip(results, names):
+        if output != "new viewer":
+            # memory-mapped and chunked, so only the displayed sections are ever read
+            res = read_mrc(res, lazy=True)[0].data
+        viewer.add_image(
+            res,
+            name=name,
+            metadata={"experiment_id": exp_id, "stack": False},
+            scale=scale,
+        )
+
+
+def _sample_spheres(spheres, spacing, exp_id, scale):
+    """Sample particles on spheres, yielding after each one; returns the particle layer tuples."""
+    pos = []
+    ori = []
+    for s in spheres:
+        ps = PoseSampler(spacing=spacing)
+        poses = ps.sample(s)
+
+        features = orientation_features(Rotation.from_matrix(poses.orientations))
+        pos.append(poses.positions)
+        ori.append(features)
+        yield
+
+    return construct_particle_layer_tuples(
+        coords=np.concatenate(pos),
+        features=pd.concat(ori, axis=0, ignore_index=True),
+        scale=scale,
+        exp_id=exp_id,
+        name_suffix="spheres picked",
     )
 
 
@@ -150,71 +406,50 @@ def _resample_filament(image_layer, filament, spacing, thickness):
     call_button="Generate",
     spacing_A={"widget_type": "FloatSlider", "min": 0.01, "max": 1000},
     inside_points={"nullable": True},
+    slicing_step={"min": 1},
+    sampling_step={"min": 1},
 )
 def surface(
     surface_input: napari.layers.Layer,
     inside_points: napari.layers.Points,
     spacing_A=50,
     closed=False,
-) -> napari.types.LayerDataTuple:
-    """create a new surface representation from picked surface points."""
+    slicing_step: int = 10,
+    sampling_step: int = 10,
+    workers: int = 0,
+) -> FunctionWorker[napari.types.LayerDataTuple]:
+    """
+    create a new surface representation from picked surface points (in the background).
+
+    slicing_step, sampling_step: for segmentations, distance in pixels between the sections
+        traced through each object, and between the points sampled along each trace
+    workers: number of surfaces (or sections) processed in parallel (0 for automatic)
+    """
+    exp_id = surface_input.metadata["experiment_id"]
+    spacing = spacing_A / surface_input.scale[0]
+    kwargs = {}
     if isinstance(surface_input, napari.layers.Shapes):
-        surface_grids, colors = _generate_surface_grids_from_shapes_layer(
-            surface_input,
-            spacing_A,
-            inside_points=inside_points,
-            closed=closed,
-        )
+        kwargs["surfaces"] = _surface_lines_from_shapes_layer(surface_input)
+        total = len(kwargs["surfaces"])
     else:
-        surface_grids, colors = _generate_surface_grids_from_labels_layer(
-            surface_input,
-            spacing_A,
-            inside_points=inside_points,
-            closed=closed,
-        )
-
-    meshes = []
-    exp_id = surface_input.metadata["experiment_id"]
-
-    for surf in surface_grids:
-        meshes.append(surf.mesh())
-
-    offset = 0
-    vert = []
-    faces = []
-    ids = []
-    for surf_id, (v, f) in enumerate(meshes):
-        f += offset
-        offset += len(v)
-        vert.append(v)
-        faces.append(f)
-        ids.append(np.full(len(v), surf_id))
-    vert = np.concatenate(vert)
-    faces = np.concatenate(faces)
-    uniq_colors, idx = np.unique(colors, axis=0, return_index=True)
-    colormap = uniq_colors[np.argsort(idx)]
-    values = np.concatenate(ids) / len(colormap)
-    # special case for colormap with 1 color because blacks get autoadded at index 0
-    if colormap.shape[0] == 1:
-        values += 1
-
-    # invert_xyz to go back to napari world (also invert faces order to preserve normals)
-    surface_layer_tuple = (
-        (invert_xyz(vert), invert_xyz(faces), values),
-        {
-            "name": f"{exp_id} - surface",
-            "metadata": {
-                "experiment_id": exp_id,
-                "surface_grids": surface_grids,
-                "surface_colors": colors,
-            },
-            "scale": surface_input.scale,
-            "shading": "smooth",
-            "colormap": colormap,
-        },
+        kwargs["labels"] = get_full_resolution(surface_input)
+        kwargs["slicing_step"] = slicing_step
+        kwargs["sampling_step"] = sampling_step
+        total = 0
+    return start_job(
         "surface",
+        _generate_surfaces,
+        exp_id,
+        surface_input.scale,
+        spacing,
+        closed,
+        _inside_point(inside_points),
+        workers=workers or None,
+        key=exp_id,
+        total=total,
+        desc=f"generating surfaces for {exp_id}",
+        **kwargs,
     )
-    return [surface_layer_tuple]
 
 
 @magicgui(
@@ -227,19 +462,15 @@ def surface_particles(
     spacing_A=50,
     masked=False,
 ) -> napari.types.LayerDataTuple:
-    surface_grids = surface.metadata.get("surface_grids", None)
-    if surface_grids is None:
-        raise ValueError("This surface layer contains no surface grid object.")
     colors = surface.metadata.get("surface_colors")
 
     exp_id = surface.metadata["experiment_id"]
     spacing = spacing_A / surface.scale[0]
+    surface_grids = _get_surface_grids(surface, spacing)
 
     pos_all = []
     ori_all = []
     for surf in surface_grids:
-        if not np.isclose(surf.separation, spacing):
-            surf.separation = spacing
         pos = surf.sample()
         ori = surf.sample_orientations()
         if masked:
@@ -249,7 +480,7 @@ def surface_particles(
         ori_all.append(ori)
 
     pos_all = np.concatenate(pos_all)
-    features = pd.DataFrame({"orientation": np.asarray(Rotation.concatenate(ori_all))})
+    features = orientation_features(Rotation.concatenate(ori_all))
 
     return construct_particle_layer_tuples(
         coords=pos_all,
@@ -266,35 +497,51 @@ def surface_particles(
     call_button="Resample",
     spacing_A={"widget_type": "FloatSlider", "min": 0.01, "max": 10000},
     thickness_A={"widget_type": "FloatSlider", "min": 0.01, "max": 10000},
+    output={"choices": RESAMPLE_OUTPUTS},
+    directory={"mode": "d"},
 )
 def resample_surface(
+    viewer: napari.Viewer,
     surface: napari.layers.Surface,
     volume: napari.layers.Image,
     spacing_A=5,
     thickness_A=200,
     masked=False,
-) -> napari.types.LayerDataTuple:
-    surface_grids = surface.metadata.get("surface_grids", None)
-    if surface_grids is None:
-        raise ValueError("This surface layer contains no surface grid object.")
-
+    workers: int = 0,
+    output="new viewer",
+    directory=Path(),
+) -> None:
+    """
+    Resample the volume around each surface (in the background) and show the results.
+
+    workers: number of surfaces resampled in parallel (0 for automatic)
+    output: keep the volumes in memory and open them in a new viewer, or write each one to
+        an mrc file in directory as soon as it is done (one subdirectory per experiment),
+        optionally opening the files lazily in the current viewer
+    directory: where to write the files (required unless output is "new viewer")
+    """
     exp_id = surface.metadata["experiment_id"]
     spacing = spacing_A / surface.scale[0]
     thickness = int(np.round(thickness_A / surface.scale[0]))
-    for surf in surface_grids:
-        if not np.isclose(surf.separation, spacing):
-            surf.separation = spacing
-
-    vols = _resample_surfaces(volume, surface_grids, spacing, thickness, masked)
-
-    v = napari.Viewer()
-    for i, vol in enumerate(vols):
-        v.add_image(
-            vol,
-            name=f"{exp_id} - surface_{i} resampled",
-            metadata={"experiment_id": exp_id, "stack": False},
-            scale=surface.scale,
-        )
+    surface_params = _get_surface_params(surface)
+    names = [f"{exp_id} - surface_{i} resampled" for i in range(len(surface_params))]
+    store = None if output == "new viewer" else _resampled_writer(directory, names, exp_id, surface.scale)
+
+    worker = start_job(
+        "resample_surface",
+        _resample_surfaces,
+        get_full_resolution(volume),
+        surface_params,
+        spacing,
+        thickness,
+        masked,
+        workers or None,
+        store,
+        key=exp_id,
+        total=len(surface_params),
+        desc=f"resampling surfaces of {exp_id}",
+    )
+    worker.returned.connect(lambda vols: _show_resampled(vols, names, exp_id, surface.scale, output, viewer))
 
 
 @magicgui(
@@ -356,7 +603,7 @@ def filament_particles(
         degrees=True,
     )
 
-    features = pd.DataFrame({"orientation": np.asarray(Rotation.concatenate(ori))})
+    features = orientation_features(Rotation.concatenate(ori))
 
     return construct_particle_layer_tuples(
         coords=pos,
@@ -372,13 +619,23 @@ def filament_particles(
     call_button="Resample",
     spacing_A={"widget_type": "FloatSlider", "min": 0.01, "max": 10000},
     thickness_A={"widget_type": "FloatSlider", "min": 0.01, "max": 10000},
+    output={"choices": RESAMPLE_OUTPUTS},
+    directory={"mode": "d"},
 )
 def resample_filament(
+    viewer: napari.Viewer,
     filament: napari.layers.Shapes,
     volume: napari.layers.Image,
     spacing_A=5,
     thickness_A=200,
-) -> napari.types.LayerDataTuple:
+    output="new viewer",
+    directory=Path(),
+) -> None:
+    """
+    Resample the volume along the filament (in the background) and show the result.
+
+    output: as in resample_surface
+    """
     helical_filament = filament.metadata.get("helical_filament", None)
     if helical_filament is None:
         raise ValueError("This shapes layer contains no helical filament object.")
@@ -386,16 +643,21 @@ def resample_filament(
     exp_id = filament.metadata["experiment_id"]
     spacing = spacing_A / filament.scale[0]
     thickness = int(np.round(thickness_A / filament.scale[0]))
-
-    vol = _resample_filament(volume, helical_filament, spacing, thickness)
-
-    v = napari.Viewer()
-    v.add_image(
-        vol,
-        name=f"{exp_id} - filament resampled",
-        metadata={"experiment_id": exp_id, "stack": False},
-        scale=filament.scale,
+    names = [f"{exp_id} - filament resampled"]
+    store = None if output == "new viewer" else _resampled_writer(directory, names, exp_id, filament.scale)
+
+    worker = start_job(
+        "resample_filament",
+        _resample_filament,
+        get_full_resolution(volume),
+        helical_filament,
+        spacing,
+        thickness,
+        store,
+        key=exp_id,
+        desc=f"resampling filament of {exp_id}",
     )
+    worker.returned.connect(lambda vol: _show_resampled([vol], names, exp_id, filament.scale, output, viewer))
 
 
 @magicgui(
@@ -461,34 +723,30 @@ def sphere(
 def sphere_particles(
     sphere_surf: napari.layers.Surface,
     spacing_A=50,
-) -> napari.types.LayerDataTuple:
+) -> FunctionWorker[napari.types.LayerDataTuple]:
     spheres = sphere_surf.metadata.get("spheres", None)
     if spheres is None:
         raise ValueError("This surface layer contains no sphere objects.")
 
     exp_id = sphere_surf.metadata["experiment_id"]
 
-    spacing_A /= sphere_surf.scale[0]
-
-    pos = []
-    ori = []
-    for s in spheres:
-        ps = PoseSampler(spacing=spacing_A)
-        poses = ps.sample(s)
+    return start_job(
+        "sphere_particles",
+        _sample_spheres,
+        spheres,
+        spacing_A / sphere_surf.scale[0],
+        exp_id,
+        sphere_surf.scale[0],
+        key=exp_id,
+        total=len(spheres),
+        desc=f"sampling spheres of {exp_id}",
+    )
 
-        features = pd.DataFrame(
-            {"orientation": np.asarray(Rotation.from_matrix(poses.orientations))}
-        )
-        pos.append(poses.positions)
-        ori.append(features)
 
-    return construct_particle_layer_tuples(
-        coords=np.concatenate(pos),
-        features=pd.concat(ori, axis=0),
-        scale=sphere_surf.scale[0],
-        exp_id=exp_id,
-        name_suffix="spheres picked",
-    )
+add_cancel_button(surface)
+add_cancel_button(resample_surface)
+add_cancel_button(resample_filament)
+add_cancel_button(sphere_particles)
 
 
 class FilamentWidget(Container):
@@ -533,5 +791,5 @@ def rotate_particles(
     if particles.metadata.get("experiment_id", None) is None:
         raise ValueError("The selected layer is not a blik Particles layer.")
     ori = Rotation.from_euler("ZYZ", (rot, tilt, psi), degrees=True)
-    particles.features.loc[list(particles.selected_data), "orientation"] = ori
+    particles.features.orientation.set(ori, index=list(particles.selected_data))
     particles.events.features()
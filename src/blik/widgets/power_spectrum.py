@@ -1,34 +1,136 @@
 from typing import TYPE_CHECKING
 
-import dask.array as da
 import numpy as np
+import pandas as pd
 from magicgui import magic_factory
-from scipy.fft import fftn, fftshift, ifftshift
+
+from ..fft import amplitude_spectrum, iter_averaged_amplitude_spectrum, radial_profile, spectrum_step
+from ..utils import current_section, get_full_resolution
+from .jobs import add_cancel_button, start_job
 
 if TYPE_CHECKING:
     import napari
 
 
+def _roi_slices(image, roi):
+    """Slices of the image data along its last two axes spanning all the shapes in roi."""
+    vertices = np.concatenate([shape[:, -2:] for shape in roi.data])
+    # from roi data coordinates to image data coordinates, through world coordinates
+    vertices = (vertices * roi.scale[-2:] + roi.translate[-2:] - image.translate[-2:]) / image.scale[-2:]
+    start = np.clip(np.floor(vertices.min(axis=0)).astype(int), 0, None)
+    stop = np.ceil(vertices.max(axis=0)).astype(int) + 1
+    return tuple(slice(lo, hi) for lo, hi in zip(start, stop))
+
+
+def _spectrum_region(viewer, image, region, slab_thickness, roi):
+    """Image data (possibly lazy) restricted to a slab around the displayed section and/or roi."""
+    data = get_full_resolution(image)
+    slices = [slice(None)] * data.ndim
+    if region == "slab" and data.ndim > 2:
+        index = current_section(viewer, image)
+        start = min(max(0, index - slab_thickness // 2), max(0, data.shape[0] - slab_thickness))
+        slices[0] = slice(start, start + slab_thickness)
+    if roi is not None and len(roi.data):
+        slices[-2:] = _roi_slices(image, roi)
+    return data[tuple(slices)]
+
+
+def _read_float32(data):
+    """Read data in memory as float32 a few sections at a time, yielding after each; returns it."""
+    if data.ndim < 3:
+        return np.asarray(data, dtype=np.float32)
+    volume = np.empty(data.shape, dtype=np.float32)
+    step = spectrum_step(data)
+    for start in range(0, data.shape[0], step):
+        volume[start : start + step] = data[start : start + step]
+        yield
+    return volume
+
+
+def _power_spectrum_layers(data, name, scale, is_2D_data, average, tile_size):
+    """
+    Log power spectrum image and radial profile points layer tuples.
+
+    Yields after each step (reading, each block of averaged sections, the fft), so it can be cancelled.
+    """
+    if average == "none":
+        axes = (-2, -1) if is_2D_data else None
+        volume = yield from _read_float32(data)
+        spectrum = amplitude_spectrum(volume, axes=axes)
+    else:
+        axes = None
+        tile_size = tile_size if average == "tiles" else None
+        spectrum = yield from iter_averaged_amplitude_spectrum(data, tile_size=tile_size)
+    yield
+
+    freq, amplitude = radial_profile(spectrum, axes=axes)
+    with np.errstate(divide="ignore"):
+        resolution = scale[-1] / freq
+    profile = pd.DataFrame({"frequency": freq, "resolution": resolution, "amplitude": amplitude})
+    # one point per bin, along the last axis starting from the center of the spectrum
+    center = np.array(spectrum.shape) // 2
+    points = np.tile(center, (len(freq), 1)).astype(float)
+    points[:, -1] += freq * 2 * (len(freq) - 1)
+
+    return [
+        (
+            np.log1p(spectrum, out=spectrum),
+            {"name": f"{name} - power spectrum", "scale": scale},
+            "image",
+        ),
+        (
+            points,
+            {"name": f"{name} - radial profile", "scale": scale, "features": profile, "size": 1},
+            "points",
+        ),
+    ]
+
+
 @magic_factory(
     auto_call=False,
     call_button="Calculate",
+    region={"choices": ["whole image", "slab"]},
+    average={"choices": ["none", "sections", "tiles"]},
+    slab_thickness={"min": 1, "max": 10000},
+    tile_size={"min": 8, "max": 4096},
+    widget_init=add_cancel_button,
 )
 def power_spectrum(
+    viewer: "napari.viewer.Viewer",
     image: "napari.layers.Image",
     is_2D_data: bool = False,
-) -> "napari.types.LayerDataTuple":
+    region: str = "whole image",
+    slab_thickness: int = 32,
+    roi: "napari.layers.Shapes | None" = None,
+    average: str = "none",
+    tile_size: int = 256,
+) -> "napari.qt.threading.FunctionWorker[napari.types.LayerDataTuple]":
     """
-    Power spectrum (log scale) of the image.
+    Power spectrum (log scale) of the image, computed in the background.
 
-    First centers in real space on the origin to remove shift effects.
+    Computed in single precision with a multithreaded real fft. The amplitude does not
+    depend on where the origin is in real space, so no centering is needed.
+    A radially averaged profile is added as the features of a points layer.
+
+    region: the whole image, or a slab of slab_thickness sections around the displayed one
+    roi: only use the area of the image covered by these shapes (in the displayed plane)
+    average: average the 2D spectra of all sections, or of tiles of tile_size pixels,
+        instead of computing a single spectrum; memory use is bounded and lazy data is read
+        a few sections at a time
     """
-    axes = (-2, -1) if is_2D_data else None
-    raw = da.compute(image.data)[0]
-    power_spectrum = np.abs(
-        fftshift(fftn(ifftshift(raw, axes=axes), axes=axes), axes=axes)
-    )
-    return (
-        np.log(power_spectrum + 1),
-        {"name": f"{image.name} - power spectrum", "scale": image.scale},
-        "image",
+    data = _spectrum_region(viewer, image, region, slab_thickness, roi)
+    scale = np.asarray(image.scale)
+    if average != "none":
+        scale = scale[-2:]
+    return start_job(
+        "power_spectrum",
+        _power_spectrum_layers,
+        data,
+        image.name,
+        scale,
+        is_2D_data,
+        average,
+        tile_size,
+        key=image.name,
+        desc=f"power spectrum of {image.name}",
     )
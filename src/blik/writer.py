@@ -1,74 +1,479 @@
+import csv
+import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+
+import mrcfile
 import numpy as np
+import pandas as pd
+from cryohub.utils.constants import Dynamo, Relion
 from cryohub.utils.generic import get_columns_or_default
 from cryohub.utils.types import PoseSet
 from cryohub.writing.mrc import write_mrc
 from cryohub.writing.star import write_star
 from cryohub.writing.tbl import write_tbl
 from cryotypes.image import Image
-from scipy.spatial.transform import Rotation
+from mrcfile.utils import mode_from_dtype
+
+from .container import write_container
+from .utils import QUAT_COLS, invert_xyz
+
+# particles are converted and written this many at a time, to bound memory use of big exports
+PARTICLE_WRITE_CHUNK_SIZE = 100_000
+# approximate amount of image data converted and written at once for lazy images
+MRC_WRITE_CHUNK_BYTES = 2**26
+
+
+def _mrc_dtype(dtype):
+    """
+    Closest dtype that can be stored in mrc files (at most 16 bit integers and 32 bit floats).
+
+    Wider integers (e.g. int32 labels) become float32 rather than being clipped, which is
+    exact up to 2**24.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return dtype if dtype.itemsize <= 2 else np.dtype(np.float32)
+    if np.issubdtype(dtype, np.floating):
+        return np.dtype(f"{dtype.kind}{min(dtype.itemsize, 4)}")
+    raise TypeError(f'cannot write mrc with dtype "{dtype}"')
+
+
+def _iter_slabs(data):
+    """Yield the start index and data of slabs along the first axis of about MRC_WRITE_CHUNK_BYTES."""
+    section_bytes = np.prod(data.shape[1:], dtype=int) * np.dtype(data.dtype).itemsize
+    step = max(1, MRC_WRITE_CHUNK_BYTES // max(section_bytes, 1))
+    chunks = getattr(data, "chunks", None)
+    if chunks is not None and chunks[0][0] <= step:
+        # align to dask chunks, so each chunk is only computed once
+        step -= step % chunks[0][0]
+    for start in range(0, data.shape[0], step):
+        yield start, np.asarray(data[start : start + step])
+
+
+def _write_mrc_chunked(path, data, pixel_spacing, stack=False, dtype=None):
+    """
+    Write an array-like (dask, memmap...) to an mrc file one slab at a time.
+
+    The file is preallocated and filled slab by slab, so the data never needs to fit in memory.
+    Data is converted to dtype if given; floats converted to integers are rescaled to span
+    the integer range (which needs an additional pass over the data), other values are clipped.
+    """
+    out_dtype = _mrc_dtype(data.dtype if dtype is None else dtype)
+    scale = offset = None
+    if np.issubdtype(data.dtype, np.floating) and np.issubdtype(out_dtype, np.integer):
+        low, high = np.inf, -np.inf
+        for _, slab in _iter_slabs(data):
+            low, high = min(low, np.nanmin(slab)), max(high, np.nanmax(slab))
+        info = np.iinfo(out_dtype)
+        scale = (int(info.max) - int(info.min)) / (high - low) if high > low else 1
+        offset = info.min - low * scale
+    limits = np.iinfo(out_dtype) if np.issubdtype(out_dtype, np.integer) else np.finfo(out_dtype)
+
+    path = Path(path)
+    if not path.suffix:
+        path = path.with_suffix(".mrc")
+    n_values = 0
+    total = total_sq = 0.0
+    dmin, dmax = np.inf, -np.inf
+    with mrcfile.new_mmap(path, data.shape, mrc_mode=mode_from_dtype(out_dtype), overwrite=True) as mrc:
+        mrc.set_image_stack() if stack else mrc.set_volume()
+        mrc.voxel_size = pixel_spacing
+        # data goes through a plain file handle rather than the memory map, so written
+        # pages do not accumulate in the memory of the process
+        section_bytes = mrc.data[0].nbytes
+        with open(path, "r+b") as f:
+            for start, slab in _iter_slabs(data):
+                if scale is not None:
+                    slab = np.round(slab * scale + offset)
+                slab = np.clip(slab, limits.min, limits.max) if slab.dtype != out_dtype else slab
+                f.seek(mrc.data.offset + start * section_bytes)
+                f.write(np.ascontiguousarray(slab, dtype=mrc.data.dtype).data)
+                # header statistics, like mrcfile computes them for in-memory data
+                slab = slab.astype(np.float64)
+                n_values += slab.size
+                total += slab.sum()
+                total_sq += np.square(slab).sum()
+                dmin, dmax = min(dmin, slab.min()), max(dmax, slab.max())
 
-from .utils import invert_xyz
+        mean = total / n_values
+        mrc.header.dmin = dmin
+        mrc.header.dmax = dmax
+        mrc.header.dmean = mean
+        mrc.header.rms = np.sqrt(max(total_sq / n_values - mean**2, 0))
 
 
-def write_image(path, data, attributes):
+def write_image(path, data, attributes, dtype=None):
+    """
+    Write an image or labels layer to an mrc file.
+
+    Lazy (dask) and memory-mapped data is written one chunk at a time without loading it
+    all in memory, as is any data converted to a different dtype (e.g. float16 or int8,
+    or float32 for integers wider than 16 bit, which mrc cannot store).
+    """
     if "experiment_id" not in attributes["metadata"]:
         raise ValueError(
             "cannot write a layer that does not have blik metadata. Add it to an experiment!"
         )
+    if attributes.get("multiscale", False):
+        data = data[0]
+    stack = attributes["metadata"].get("stack", False)
+    if (
+        dtype is not None
+        or isinstance(data, np.memmap)
+        or not isinstance(data, np.ndarray)
+        or _mrc_dtype(data.dtype) != data.dtype
+    ):
+        _write_mrc_chunked(path, data, attributes["scale"][0], stack=stack, dtype=dtype)
+        return [path]
+
     img = Image(
         data=data,
         experiment_id=attributes["metadata"]["experiment_id"],
         pixel_spacing=attributes["scale"][0],
-        stack=attributes["metadata"].get("stack", False),
+        stack=stack,
         source=attributes["metadata"].get("source", ""),
     )
     write_mrc(img, str(path), overwrite=True)
     return [path]
 
 
-def _generate_particle_set(layer_data):
-    particles = []
+def _particle_layers(layer_data):
+    layers = []
     for data, attributes, layer_type in layer_data:
         if layer_type == "vectors":
             # vector info is actually held in particles, but this makes it
             # convenient to select everything and save
-            pass
-        elif "experiment_id" in attributes["metadata"]:
-            data = invert_xyz(data)
-            shift_cols = ["shift_z", "shift_y", "shift_x"]
-            features = attributes["features"].drop(
-                columns=["orientation", *shift_cols], errors="ignore"
+            continue
+        if "experiment_id" not in attributes["metadata"]:
+            raise ValueError(
+                "cannot write a layer that does not have blik metadata. Add it to an experiment!"
             )
+        layers.append((data, attributes))
+    return layers
 
-            shift = get_columns_or_default(attributes["features"], shift_cols)
-            if shift is not None:
-                shift = invert_xyz(shift)
-                data = data - shift
-            ori = get_columns_or_default(attributes["features"], "orientation")
-            if ori is not None:
-                ori = Rotation.concatenate(ori.reshape(-1))
-
-            particles.append(
-                PoseSet(
-                    position=data,
-                    shift=shift,
-                    orientation=ori,
-                    experiment_id=attributes["metadata"]["experiment_id"],
-                    pixel_spacing=attributes["scale"][0],
-                    source=attributes["metadata"].get("source", ""),
-                    features=features,
-                )
-            )
+
+def _layer_to_poseset(data, attributes, features):
+    data = invert_xyz(data)
+    shift_cols = ["shift_z", "shift_y", "shift_x"]
+    shift = get_columns_or_default(features, shift_cols)
+    if shift is not None:
+        shift = invert_xyz(shift)
+        data = data - shift
+    ori = None
+    if features.orientation.available:
+        ori = features.orientation.rotation
+
+    return PoseSet(
+        position=data,
+        shift=shift,
+        orientation=ori,
+        experiment_id=attributes["metadata"]["experiment_id"],
+        pixel_spacing=attributes["scale"][0],
+        source=attributes["metadata"].get("source", ""),
+        features=features.drop(columns=["orientation", *QUAT_COLS, *shift_cols], errors="ignore"),
+    )
+
+
+def _iter_poseset_chunks(layers):
+    for i, (data, attributes) in enumerate(layers):
+        for start in range(0, len(data), PARTICLE_WRITE_CHUNK_SIZE):
+            stop = start + PARTICLE_WRITE_CHUNK_SIZE
+            yield i, _layer_to_poseset(data[start:stop], attributes, attributes["features"].iloc[start:stop])
+
+
+# mirror cryohub's write_star and write_tbl, but one chunk at a time
+
+
+def _star_flags(poseset, version):
+    shift = poseset.shift
+    if shift is not None and version != "3.0":
+        shift = shift * poseset.pixel_spacing
+    ori = poseset.orientation
+    return np.array(
+        [
+            np.allclose(poseset.position[:, 2], 0),
+            shift is not None and np.allclose(shift[:, 2], 0),
+            ori is not None and np.allclose(ori.inv().as_rotvec(degrees=True)[:, :2], 0),
+        ]
+    )
+
+
+def _star_frame(poseset, flags, version):
+    pos_2d, shift_2d, single_angle = flags
+    df = pd.DataFrame()
+    if pos_2d:
+        df[Relion.COORD_HEADERS[:2]] = poseset.position[:, :2]
+    else:
+        df[Relion.COORD_HEADERS] = poseset.position
+
+    px_size = poseset.pixel_spacing
+    df[Relion.PIXEL_SIZE_HEADER[version]] = px_size
+
+    shift = poseset.shift
+    if shift is not None:
+        if version != "3.0":
+            shift = shift * px_size
+        # shifts are subtractive in relion
+        shift = -shift
+        if shift_2d:
+            df[Relion.SHIFT_HEADERS[version][:2]] = shift[:, :2]
         else:
-            raise ValueError(
-                "cannot write a layer that does not have blik metadata. Add it to an experiment!"
+            df[Relion.SHIFT_HEADERS[version]] = shift
+
+    ori = poseset.orientation
+    if ori is not None:
+        if single_angle:
+            df[Relion.EULER_HEADERS[2]] = ori.inv().as_rotvec(degrees=True)[:, 2]
+        else:
+            df[Relion.EULER_HEADERS] = ori.inv().as_euler(Relion.EULER, degrees=True)
+
+    df["experiment_id"] = poseset.experiment_id
+    if poseset.features is not None:
+        df = pd.concat([df, poseset.features.reset_index(drop=True)], axis=1)
+    return df
+
+
+def _tbl_flags(poseset):
+    ori = poseset.orientation
+    return np.array(
+        [
+            np.allclose(poseset.position[:, 2], 0),
+            poseset.shift is not None and np.allclose(poseset.shift[:, 2], 0),
+            ori is not None and np.allclose(ori.inv().as_rotvec(degrees=True)[:, :2], 0),
+        ]
+    )
+
+
+def _tbl_frame(poseset, flags):
+    pos_2d, shift_2d, single_angle = flags
+    df = pd.DataFrame()
+    if pos_2d:
+        df[Dynamo.COORD_HEADERS[:2]] = poseset.position[:, :2]
+    else:
+        df[Dynamo.COORD_HEADERS] = poseset.position
+
+    shift = poseset.shift
+    if shift is not None:
+        if shift_2d:
+            df[Dynamo.SHIFT_HEADERS[:2]] = shift[:, :2]
+        else:
+            df[Dynamo.SHIFT_HEADERS] = shift
+
+    ori = poseset.orientation
+    if ori is not None:
+        if single_angle:
+            df[Dynamo.EULER_HEADERS[2]] = ori.inv().as_rotvec(degrees=True)[:, 2:]
+        else:
+            df[Dynamo.EULER_HEADERS[3]] = ori.inv().as_euler(Dynamo.EULER, degrees=True)
+
+    df["experiment_id"] = poseset.experiment_id
+    if poseset.features is not None and Dynamo.EXP_ID_HEADER in poseset.features.columns:
+        df[Dynamo.EXP_ID_HEADER] = poseset.features[Dynamo.EXP_ID_HEADER].to_numpy()
+    return df
+
+
+def _particle_table_chunks(layers, flags_func, frame_func):
+    if not layers or any(len(data) == 0 for data, _ in layers):
+        return None
+    flags = [None] * len(layers)
+    for i, poseset in _iter_poseset_chunks(layers):
+        chunk_flags = flags_func(poseset)
+        flags[i] = chunk_flags if flags[i] is None else flags[i] & chunk_flags
+
+    heads = [
+        frame_func(_layer_to_poseset(data[:1], attr, attr["features"].iloc[:1]), flags[i])
+        for i, (data, attr) in enumerate(layers)
+    ]
+    if any(head.columns.has_duplicates for head in heads):
+        return None
+    schema = pd.concat(heads).iloc[:0]
+    dtypes = schema.dtypes.to_dict()
+
+    def chunks():
+        for i, poseset in _iter_poseset_chunks(layers):
+            yield frame_func(poseset, flags[i]).reindex(columns=schema.columns).astype(dtypes)
+
+    return chunks
+
+
+def _starfile_formatting():
+    """
+    The (private) starfile helpers formatting star files, used to write them chunk by chunk.
+
+    starfile is pinned, but if they move anyway, None is returned (with a warning) so particles
+    are written in one go with the public writer instead.
+    """
+    try:
+        from starfile.writer import loop_block, package_info, quote
+    except ImportError as e:
+        warnings.warn(f"cannot write star files chunk by chunk ({e}), writing them in one go", stacklevel=3)
+        return None
+    return package_info, loop_block, quote
+
+
+def _dynamotable_formatting():
+    """
+    The (private) dynamotable column order and file naming, used to write tables chunk by chunk.
+
+    Like _starfile_formatting, None is returned (with a warning) if they moved.
+    """
+    try:
+        from dynamotable.io import COLUMN_NAMES, sanitise_table_filename
+    except ImportError as e:
+        warnings.warn(f"cannot write dynamo tables chunk by chunk ({e}), writing them in one go", stacklevel=3)
+        return None
+    return COLUMN_NAMES, sanitise_table_filename
+
+
+def _scan_star_chunks(chunks, object_columns, key_columns, quote):
+    """
+    Check that object columns are formatted the same in every chunk and as a whole, and collect
+    the unique values of key_columns, in a single pass.
+    """
+    # starfile re-infers dtypes of object columns, which changes how they are formatted
+    samples = {col: {} for col in object_columns}
+    has_nan = dict.fromkeys(object_columns, False)
+    chunk_floats = []
+    keys = []
+    for chunk in chunks():
+        floats = {}
+        for col in object_columns:
+            mapped = chunk[col].map(quote)
+            values = mapped[mapped.notna()]
+            has_nan[col] |= len(values) < len(mapped)
+            samples[col].update({type(v): v for v in values})
+            if len(values):
+                floats[col] = mapped.dtype.kind == "f"
+        chunk_floats.append(floats)
+        if key_columns:
+            keys.append(chunk[key_columns].drop_duplicates())
+
+    for col in object_columns:
+        sample = pd.Series([*samples[col].values(), *([np.nan] if has_nan[col] else [])], dtype=object)
+        full_float = sample.map(quote).dtype.kind == "f"
+        if any(floats.get(col, full_float) != full_float for floats in chunk_floats):
+            return False, None
+    return True, pd.concat(keys).drop_duplicates() if keys else None
+
+
+def _stream_particles_star(path, layers, version):
+    formatting = _starfile_formatting()
+    if formatting is None:
+        return False
+    package_info, loop_block, quote = formatting
+    chunks = _particle_table_chunks(
+        layers, partial(_star_flags, version=version), partial(_star_frame, version=version)
+    )
+    if chunks is None:
+        return False
+    first_chunk = next(chunks())
+    columns = list(first_chunk.columns)
+    object_columns = [col for col, dtype in first_chunk.dtypes.items() if pd.api.types.is_object_dtype(dtype)]
+
+    # like cryohub's extract_optics
+    optics_headers = [h for h in Relion.POSSIBLE_OPTICS_GROUP_HEADERS if h in columns]
+    group_header = Relion.OPTICS_GROUP_HEADER
+    key_columns = []
+    if version != "3.0":
+        key_columns = list(dict.fromkeys(h for h in [group_header, *optics_headers] if h in columns))
+    keys = None
+    if object_columns or key_columns:
+        consistent, keys = _scan_star_chunks(chunks, object_columns, key_columns, quote)
+        if not consistent:
+            return False
+
+    optics = None
+    add_optics_group = None
+    if version != "3.0":
+        if group_header in columns:
+            optics = keys.get([group_header, *optics_headers]).drop_duplicates().reset_index(drop=True)
+        elif optics_headers:
+            keys[group_header] = keys.groupby(optics_headers).ngroup()
+            optics = keys.get([group_header, *optics_headers]).drop_duplicates().reset_index(drop=True)
+
+            def add_optics_group(chunk):
+                groups = pd.concat([keys[optics_headers], chunk[optics_headers]]).groupby(optics_headers).ngroup()
+                chunk[group_header] = groups.to_numpy()[len(keys) :]
+        else:
+            optics = pd.DataFrame({group_header: [0]})
+
+            def add_optics_group(chunk):
+                chunk[group_header] = 0
+
+    path = Path(path)
+    if not path.suffix:
+        path = path.with_suffix(".star")
+    with open(path, "w") as f:
+        f.write(package_info() + "\n\n\n")
+        if optics is not None:
+            f.writelines(line + "\n" for line in loop_block("optics", optics))
+        header_written = False
+        for chunk in chunks():
+            if version != "3.0":
+                if add_optics_group is not None:
+                    add_optics_group(chunk)
+                chunk = chunk.drop(columns=optics_headers, errors="ignore")
+            if not header_written:
+                block_name = "particles" if version != "3.0" else ""
+                loop_header = [f"_{col} #{i}" for i, col in enumerate(chunk.columns, 1)]
+                f.writelines(line + "\n" for line in [f"data_{block_name}", "", "loop_", *loop_header])
+                header_written = True
+            text = chunk.map(quote).to_csv(
+                sep="\t",
+                header=False,
+                index=False,
+                float_format="%.6f",
+                na_rep="<NA>",
+                quoting=csv.QUOTE_NONE,
             )
-    return particles
+            f.writelines(line + "\n" for line in text.splitlines())
+        f.write("\n\n")
+    return True
+
+
+def _stream_particles_tbl(path, layers):
+    formatting = _dynamotable_formatting()
+    if formatting is None:
+        return False
+    column_names, sanitise_table_filename = formatting
+    # write_tbl aligns the exp id feature on the index
+    if any(not attr["features"].index.equals(pd.RangeIndex(len(data))) for data, attr in layers):
+        return False
+    chunks = _particle_table_chunks(layers, _tbl_flags, _tbl_frame)
+    if chunks is None:
+        return False
+
+    path = Path(path)
+    if not path.suffix:
+        path = path.with_suffix(".tbl")
+    # like dynamotable.write
+    tag = 1
+    with open(sanitise_table_filename(path), "w", encoding="utf-8", newline="") as f:
+        for chunk in chunks():
+            n_rows = len(chunk)
+            data = {}
+            for column_name in column_names:
+                if column_name in chunk.columns:
+                    data[column_name] = chunk[column_name]
+                elif column_name == "tag":
+                    data[column_name] = [x + tag for x in range(n_rows)]
+                elif column_name == "aligned_value":
+                    data[column_name] = [1] * n_rows
+                else:
+                    data[column_name] = [0] * n_rows
+            pd.DataFrame.from_dict(data).to_csv(f, sep=" ", header=False, index=False)
+            tag += n_rows
+    return True
 
 
 def _write_particles_star(path, layer_data, relion_version):
-    particles = _generate_particle_set(layer_data)
-    write_star(particles, path, overwrite=True, version=relion_version)
+    layers = _particle_layers(layer_data)
+    if not _stream_particles_star(path, layers, relion_version):
+        particles = [_layer_to_poseset(data, attr, attr["features"]) for data, attr in layers]
+        write_star(particles, path, overwrite=True, version=relion_version)
     return [path]
 
 
@@ -85,8 +490,10 @@ def write_particles_relion_40(path, layer_data):
 
 
 def write_particles_dynamo(path, layer_data):
-    particles = _generate_particle_set(layer_data)
-    write_tbl(particles, path, overwrite=True)
+    layers = _particle_layers(layer_data)
+    if not _stream_particles_tbl(path, layers):
+        particles = [_layer_to_poseset(data, attr, attr["features"]) for data, attr in layers]
+        write_tbl(particles, path, overwrite=True)
     return [path]
 
 
@@ -100,21 +507,25 @@ def write_surface_picks(path, data, attributes):
         path = str(path) + ".picks"
 
     exp_id = str(attributes["metadata"]["experiment_id"])
-    scale = attributes["scale"]
-    surf_id = attributes["features"]["surface_id"]
-    edge_color_cycle = attributes["edge_color_cycle"]
-    with open(path, "wb") as f:
-        np.save(f, scale)
-        np.save(f, surf_id)
-        np.save(f, edge_color_cycle)
-        for line in data:
-            np.save(f, line)
-        # exp ID at the end cause it has variable length and is not a np array
-        f.write(exp_id.encode())
+    lines = [np.asarray(line, dtype=float) for line in data]
+    # surfaces are fit to lines in zyx, so only 3D picks can be written
+    ndim = attributes.get("ndim", 3)
+    if ndim != 3 or any(line.ndim != 2 or line.shape[1] != 3 for line in lines):
+        raise ValueError(f"surface picks must be 3D paths, but layer {attributes.get('name', '')!r} is {ndim}D")
+    # all lines are stored as a single array, with their start and end in line_offsets
+    line_offsets = np.cumsum([0] + [len(line) for line in lines])
+    arrays = {
+        "scale": np.asarray(attributes["scale"], dtype=float),
+        "surface_id": np.asarray(attributes["features"]["surface_id"]),
+        "edge_color_cycle": np.asarray(attributes["edge_color_cycle"], dtype=float),
+        "points": np.concatenate(lines) if lines else np.empty((0, 3)),
+        "line_offsets": line_offsets,
+    }
+    write_container(path, arrays, {"format": "picks", "experiment_id": exp_id})
     return [path]
 
 
-def write_surface(path, data, attributes):
+def write_surface(path, data, attributes, compress=False):
     if "experiment_id" not in attributes["metadata"]:
         raise ValueError(
             "cannot write a layer that does not have blik metadata. Add it to an experiment!"
@@ -124,15 +535,99 @@ def write_surface(path, data, attributes):
         path = str(path) + ".surf"
 
     exp_id = str(attributes["metadata"]["experiment_id"])
-    scale = attributes["scale"]
-    # TODO: needs to exposed in napari
-    # colormap = attributes['colormap']['colors']
-    with open(path, "wb") as f:
-        np.save(f, scale)
-        # TODO: needs to exposed in napari
-        # np.save(f, colormap)
-        for d in data:
-            np.save(f, d)
-        # exp ID at the end cause it has variable length and is not a np array
-        f.write(exp_id.encode())
+    vertices, faces, values = data[:3]
+    # float32 and int32 are plenty for meshes and halve the size compared to numpy defaults
+    faces_dtype = np.int32 if len(vertices) < np.iinfo(np.int32).max else np.int64
+    arrays = {
+        "scale": np.asarray(attributes["scale"], dtype=float),
+        "vertices": np.asarray(vertices, dtype=np.float32),
+        "faces": np.asarray(faces, dtype=faces_dtype),
+        "values": np.asarray(values, dtype=np.float32),
+    }
+    metadata = {"format": "surf", "experiment_id": exp_id}
+
+    colors = attributes["metadata"].get("surface_colors", None)
+    if colors is not None:
+        arrays["surface_colors"] = np.asarray(colors, dtype=float)
+    params = attributes["metadata"].get("surface_params", None)
+    if params is not None:
+        # spline points of all surfaces are stored as a single array, like .picks lines
+        lines = [np.asarray(line, dtype=float) for p in params for line in p["points"]]
+        arrays["surface_points"] = np.concatenate(lines) if lines else np.empty((0, 3))
+        arrays["surface_line_offsets"] = np.cumsum([0] + [len(line) for line in lines])
+        arrays["surface_line_counts"] = np.array([len(p["points"]) for p in params])
+        metadata["surface_params"] = []
+        for p in params:
+            p = {k: v for k, v in p.items() if k != "points"}
+            if p.get("inside_point") is not None:
+                p["inside_point"] = np.asarray(p["inside_point"], dtype=float).tolist()
+            metadata["surface_params"].append(p)
+
+    write_container(path, arrays, metadata, compress=compress)
     return [path]
+
+
+PARTICLE_WRITERS = {
+    "relion_30": (write_particles_relion_30, ".star"),
+    "relion_31": (write_particles_relion_31, ".star"),
+    "relion_40": (write_particles_relion_40, ".star"),
+    "dynamo": (write_particles_dynamo, ".tbl"),
+}
+
+
+def _safe_filename(name):
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("_")
+
+
+def export_tasks(layer_data, directory, particles_format="relion_40"):
+    """Writer, path and arguments for each layer with blik metadata, in a directory per experiment."""
+    particles_writer, particles_ext = PARTICLE_WRITERS[particles_format]
+    tasks = []
+    used_stems = set()
+    for data, attributes, layer_type in layer_data:
+        exp_id = attributes.get("metadata", {}).get("experiment_id", None)
+        if exp_id is None:
+            continue
+        stem = Path(directory) / _safe_filename(exp_id) / _safe_filename(attributes["name"])
+        # layers with the same name would overwrite each other
+        base, i = stem, 1
+        while stem in used_stems:
+            stem = base.with_name(f"{base.name}_{i}")
+            i += 1
+        used_stems.add(stem)
+        if layer_type in ("image", "labels"):
+            tasks.append((write_image, stem.with_suffix(".mrc"), data, attributes))
+        elif layer_type == "points" and attributes["metadata"].get("p_id", None) is not None:
+            tasks.append((particles_writer, stem.with_suffix(particles_ext), [(data, attributes, layer_type)]))
+        elif layer_type == "shapes":
+            tasks.append((write_surface_picks, stem.with_suffix(".picks"), data, attributes))
+        elif layer_type == "surface":
+            tasks.append((write_surface, stem.with_suffix(".surf"), data, attributes))
+    return tasks
+
+
+def iter_export_experiments(layer_data, directory, particles_format="relion_40", workers=None):
+    """
+    Write all layers with blik metadata to directory, in a subdirectory per experiment_id.
+
+    Images and segmentations are written as mrc, particles with the given format (one of
+    PARTICLE_WRITERS), surface picks and surfaces with the blik formats. Files are written
+    concurrently by the given number of workers (None for an automatic amount).
+    Yields the paths as they are written, so progress can be followed.
+    """
+    tasks = export_tasks(layer_data, directory, particles_format)
+    for _, path, *_ in tasks:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(writer, path, *args) for writer, path, *args in tasks]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def export_experiments(layer_data, directory, particles_format="relion_40", workers=None):
+    """
+    Write all layers with blik metadata to directory, in a subdirectory per experiment_id.
+
+    See iter_export_experiments. Returns the list of written paths.
+    """
+    return list(iter_export_experiments(layer_data, directory, particles_format, workers))
@@ -1,4 +1,44 @@
-from blik.reader import construct_particle_layer_tuples, get_reader
+import gc
+import pickle
+import shutil
+import sys
+import weakref
+from pathlib import Path
+
+import dask.array as da
+import mrcfile
+import napari
+import numpy as np
+import pytest
+from cryohub.writing.star import write_star
+from cryohub.writing.tbl import write_tbl
+from morphosamplers.surface_spline import GriddedSplineSurface
+from scipy.spatial.transform import Rotation
+
+from blik.cache import ArrayCache, _evict_particle_cache, materialized
+from blik.pyramid import build_pyramid, load_cached_pyramid
+from blik.reader import (
+    _pyramid_builds,
+    construct_image_layer_tuple,
+    construct_particle_layer_tuples,
+    get_reader,
+    read_layers,
+    read_surface,
+    read_surface_picks,
+)
+from blik.utils import orientation_features
+from blik.widgets.picking import _surface_grid_params
+from blik.writer import (
+    _layer_to_poseset,
+    export_experiments,
+    write_image,
+    write_particles_dynamo,
+    write_particles_relion_30,
+    write_particles_relion_31,
+    write_particles_relion_40,
+    write_surface,
+    write_surface_picks,
+)
 
 
 def test_reader(star_file):
@@ -34,3 +74,297 @@ def test_napari_read(star_file, mrc_file, make_napari_viewer):
     v = make_napari_viewer()
     v.open(star_file, plugin='blik')
     v.open(mrc_file, plugin='blik')
+
+
+def test_orientation_roundtrip(tmp_path):
+    ori = Rotation.random(5, random_state=0)
+    layer_data_list = construct_particle_layer_tuples(
+        coords=np.random.rand(5, 3) * 100,
+        features=orientation_features(ori),
+        scale=1,
+        exp_id="test",
+    )
+    features = layer_data_list[0][1]["features"]
+    assert "orientation" not in features.columns
+    assert features.orientation.quat.shape == (5, 4)
+
+    out = tmp_path / "out.star"
+    write_particles_relion_40(out, layer_data_list)
+    reread = get_reader(out)(out)[0][1]["features"]
+    assert np.allclose(reread.orientation.rotation.as_matrix(), ori.as_matrix())
+
+
+def test_parallel_read(star_file, mrc_file):
+    sequential = read_layers(star_file, mrc_file, workers=1)
+    parallel = read_layers(star_file, mrc_file, workers=2)
+    assert [lay[1]["name"] for lay in parallel] == [lay[1]["name"] for lay in sequential]
+    # images come first
+    assert parallel[0][2] == "image"
+
+
+def test_lazy_mrc(mrc_file, monkeypatch):
+    # 10x10 float32 sections, so 2 sections per chunk
+    monkeypatch.setattr("blik.reader.LAZY_CHUNK_BYTES", 800)
+    lazy = read_layers(mrc_file, lazy=True)[0][0]
+    assert isinstance(lazy, da.Array)
+    assert lazy.chunksize == (2, 10, 10)
+    # small files are memory-mapped by default, copy-on-write so they can be edited
+    mapped = read_layers(mrc_file)[0][0]
+    assert isinstance(mapped, np.memmap)
+    np.testing.assert_array_equal(lazy.compute(), mapped)
+    mapped[0, 0, 0] += 1
+    assert read_layers(mrc_file)[0][0][0, 0, 0] == lazy[0, 0, 0].compute()
+    # loaded in memory only if requested
+    loaded = read_layers(mrc_file, lazy=False)[0][0]
+    assert type(loaded) is np.ndarray
+    np.testing.assert_array_equal(loaded, lazy.compute())
+    # files above the threshold are lazy by default
+    monkeypatch.setattr("blik.reader.LAZY_SIZE_THRESHOLD", mrc_file.stat().st_size - 1)
+    assert isinstance(read_layers(mrc_file)[0][0], da.Array)
+
+
+def test_multiscale_pyramid(mrc_file, tmp_path, monkeypatch):
+    monkeypatch.setattr("blik.pyramid.PYRAMID_CACHE_DIR", tmp_path)
+    monkeypatch.setattr("blik.pyramid.PYRAMID_MIN_SIZE", 4)
+    data, attrs, _ = read_layers(mrc_file, multiscale=True)[0]
+    assert attrs["multiscale"]
+    assert [level.shape for level in data] == [(10, 10, 10), (5, 5, 5), (2, 2, 2)]
+    assert np.isclose(data[1].mean(), np.asarray(data[0])[:10, :10, :10].mean())
+
+    # second read uses the cache
+    cached = read_layers(mrc_file, multiscale=True)[0][0]
+    assert cached[1].filename == data[1].filename
+
+
+def test_multiscale_pyramid_background(mrc_file, tmp_path, monkeypatch, qtbot):
+    monkeypatch.setattr("blik.pyramid.PYRAMID_CACHE_DIR", tmp_path / "pyramids")
+    monkeypatch.setattr("blik.pyramid.PYRAMID_MIN_SIZE", 4)
+    monkeypatch.setattr("blik.reader.PYRAMID_SIZE_THRESHOLD", 0)
+    # pyramids are not built while reading, but in the background; binned levels stride the data until then
+    data, attrs, _ = read_layers(mrc_file)[0]
+    assert attrs["multiscale"]
+    assert [level.shape for level in data] == [(10, 10, 10), (5, 5, 5), (2, 2, 2)]
+    np.testing.assert_array_equal(np.asarray(data[1]), np.asarray(data[0])[::2, ::2, ::2])
+
+    viewer = napari.components.ViewerModel()
+    layer = viewer.add_image(data, multiscale=True, metadata=attrs["metadata"])
+    qtbot.waitUntil(lambda: not _pyramid_builds)
+    # the layer that was read now shows the built levels
+    built = load_cached_pyramid(data[0], mrc_file)
+    assert viewer.layers[0] is layer
+    np.testing.assert_array_equal(layer.data[1][:], built[1])
+    # once built, they are used right away
+    assert isinstance(read_layers(mrc_file)[0][0][1], np.memmap)
+
+
+def test_pyramid_cache_eviction(mrc_file, tmp_path, monkeypatch):
+    monkeypatch.setattr("blik.pyramid.PYRAMID_CACHE_DIR", tmp_path / "pyramids")
+    monkeypatch.setattr("blik.pyramid.PYRAMID_MIN_SIZE", 4)
+    monkeypatch.setattr("blik.pyramid.PYRAMID_CACHE_MAX_BYTES", 1000)
+    other = shutil.copy(mrc_file, tmp_path / "other.mrc")
+    data = np.zeros((10, 10, 10), np.float32)
+    build_pyramid(data, mrc_file)
+    assert load_cached_pyramid(data, mrc_file) is not None
+    # the least recently used pyramid is dropped to make space
+    build_pyramid(data, other)
+    assert load_cached_pyramid(data, mrc_file) is None
+    assert load_cached_pyramid(data, other) is not None
+
+
+def test_particle_cache(star_file, tmp_path, monkeypatch):
+    monkeypatch.setattr("blik.cache.PARTICLE_CACHE_DIR", tmp_path)
+    first = read_layers(star_file)
+    assert len(list(tmp_path.glob("*.pkl"))) == 1
+    second = read_layers(star_file)
+    for (data1, kwargs1, _), (data2, kwargs2, _) in zip(first, second):
+        assert np.allclose(data1, data2)
+        if "features" in kwargs1:
+            assert kwargs1["features"].equals(kwargs2["features"])
+
+    # entries that cannot be loaded anymore (e.g. after upgrades) are parsed again
+    (cache_path,) = tmp_path.glob("*.pkl")
+    cache_path.write_bytes(pickle.dumps([{"position": None}]))
+    assert len(read_layers(star_file)) == len(first)
+    assert pickle.loads(cache_path.read_bytes())[0]["quat"] is not None
+    cache_path.write_bytes(cache_path.read_bytes()[:10])
+    assert len(read_layers(star_file)) == len(first)
+    # a new version of blik (or cryohub) does not use old entries
+    monkeypatch.setattr("blik.cache.__version__", "0.0.0")
+    read_layers(star_file)
+    assert len(list(tmp_path.glob("*.pkl"))) == 2
+    # entries removed while evicting (e.g. by another process) are skipped
+    (tmp_path / "gone.pkl").symlink_to(tmp_path / "missing.pkl")
+    monkeypatch.setattr("blik.cache.PARTICLE_CACHE_MAX_BYTES", 0)
+    _evict_particle_cache()
+    assert list(tmp_path.glob("*.pkl")) == [tmp_path / "gone.pkl"]
+
+
+def test_volume_cache():
+    calls = []
+
+    def load(block):
+        calls.append(1)
+        return block
+
+    data = da.from_array(np.random.rand(4, 5, 6)).map_blocks(load)
+    calls.clear()
+    volume = materialized(data)
+    assert materialized(data) is volume
+    assert len(calls) == 1
+    arr = np.zeros(3)
+    assert materialized(arr) is arr
+
+    cache = ArrayCache(max_bytes=100)
+    cache.put(data, 1, value=np.zeros(10))
+    cache.put(data, 2, value=np.zeros(10))
+    assert cache.get(data, 1) is None
+    assert cache.get(data, 2) is not None
+    assert cache.get(da.zeros(3), 2) is None
+
+    # volumes are released with their source (e.g. when its layer is removed)
+    volume = weakref.ref(cache.get(data, 2))
+    del data
+    gc.collect()
+    assert volume() is None
+    assert not cache._entries
+
+
+def test_surface_picks_roundtrip(tmp_path):
+    lines = [np.random.rand(n, 3) for n in (3, 5, 4)]
+    attributes = {
+        "metadata": {"experiment_id": "test"},
+        "scale": np.array([2.0, 2.0, 2.0]),
+        "features": {"surface_id": np.array([0, 1, 1])},
+        "edge_color_cycle": np.eye(4),
+    }
+    path = write_surface_picks(tmp_path / "test.picks", lines, attributes)[0]
+
+    data, kwargs, _ = read_surface_picks(path)
+    assert kwargs["metadata"]["experiment_id"] == "test"
+    assert all(np.allclose(a, b) for a, b in zip(data, lines))
+
+    data, kwargs, _ = read_surface_picks(path, surface_ids=[1])
+    assert len(data) == 2
+    assert np.allclose(data[1], lines[2])
+    assert np.array_equal(kwargs["features"]["surface_id"], [1, 1])
+
+    # 4D picks (e.g. with a time axis) are not silently reshaped
+    with pytest.raises(ValueError, match="3D"):
+        write_surface_picks(tmp_path / "4d.picks", [np.random.rand(4, 4)], {**attributes, "ndim": 4})
+
+    # legacy stream format
+    legacy = tmp_path / "legacy.picks"
+    with open(legacy, "wb") as f:
+        np.save(f, attributes["scale"])
+        np.save(f, attributes["features"]["surface_id"])
+        np.save(f, attributes["edge_color_cycle"])
+        for line in lines:
+            np.save(f, line)
+        f.write(b"test")
+    data, kwargs, _ = read_surface_picks(legacy)
+    assert kwargs["metadata"]["experiment_id"] == "test"
+    assert all(np.allclose(a, b) for a, b in zip(data, lines))
+
+
+def test_surface_roundtrip(tmp_path):
+    lines = [np.stack([np.linspace(0, 50, 6), np.full(6, y), np.full(6, 10.0)], axis=1) for y in (0, 20, 40)]
+    surf = GriddedSplineSurface(points=lines, separation=10)
+    vert, faces = surf.mesh()
+    attributes = {
+        "metadata": {
+            "experiment_id": "test",
+            "surface_params": [_surface_grid_params(surf)],
+            "surface_colors": np.ones((3, 4)),
+        },
+        "scale": np.array([2.0, 2.0, 2.0]),
+    }
+    path = write_surface(tmp_path / "test.surf", (vert, faces, np.zeros(len(vert))), attributes)[0]
+
+    (vert2, faces2, _), kwargs, _ = read_surface(path)
+    assert vert2.dtype == np.float32 and faces2.dtype == np.int32
+    assert np.allclose(vert2, vert, atol=1e-3)
+    assert np.array_equal(faces2, faces)
+    params = kwargs["metadata"]["surface_params"][0]
+    rebuilt = GriddedSplineSurface(**params)
+    assert np.allclose(rebuilt.sample(), surf.sample())
+
+
+@pytest.mark.parametrize("version", ["3.0", "3.1", "4.0"])
+def test_streaming_particle_writer(tmp_path, monkeypatch, version):
+    monkeypatch.setattr("blik.writer.PARTICLE_WRITE_CHUNK_SIZE", 3)
+    layers = []
+    for exp_id, n, scale, voltage in (("a", 10, 2, 300), ("b", 7, 3, 200)):
+        features = orientation_features(Rotation.random(n, random_state=0))
+        features["shift_x"] = np.random.rand(n)
+        # optics group columns, with a different group per experiment
+        features["rlnVoltage"] = voltage
+        attributes = {"metadata": {"experiment_id": exp_id}, "scale": [scale] * 3, "features": features}
+        layers.append((np.random.rand(n, 3) * 100, attributes, "points"))
+    posesets = [_layer_to_poseset(data, attr, attr["features"]) for data, attr, _ in layers]
+
+    write_star(posesets, tmp_path / "full.star", version=version)
+    # make sure the streaming writer is used, and not the fallback
+    monkeypatch.setattr("blik.writer.write_star", None)
+    writer = {"3.0": write_particles_relion_30, "3.1": write_particles_relion_31, "4.0": write_particles_relion_40}
+    writer[version](tmp_path / "streamed.star", layers)
+    # first line is a timestamp
+    streamed = (tmp_path / "streamed.star").read_text().split("\n", 1)[1]
+    assert streamed == (tmp_path / "full.star").read_text().split("\n", 1)[1]
+    if version == "3.1":
+        assert "rlnImagePixelSize" in streamed.split("data_particles")[0]
+
+    monkeypatch.setattr("blik.writer.write_tbl", None)
+    write_particles_dynamo(tmp_path / "streamed.tbl", layers)
+    write_tbl(posesets, tmp_path / "full.tbl")
+    assert (tmp_path / "streamed.tbl").read_bytes() == (tmp_path / "full.tbl").read_bytes()
+
+    # if the starfile internals move, the public writer is used instead
+    monkeypatch.setattr("blik.writer.write_star", write_star)
+    monkeypatch.setitem(sys.modules, "starfile.writer", None)
+    with pytest.warns(UserWarning, match="chunk by chunk"):
+        writer[version](tmp_path / "fallback.star", layers)
+    assert (tmp_path / "fallback.star").read_text().split("\n", 1)[1] == streamed
+
+
+def test_export_experiments(tmp_path):
+    layer_data = [
+        construct_image_layer_tuple(np.zeros((4, 4, 4), np.float32), scale=1, exp_id="a"),
+        *construct_particle_layer_tuples(coords=np.random.rand(5, 3), features=None, scale=1, exp_id="a"),
+        *construct_particle_layer_tuples(coords=np.random.rand(3, 3), features=None, scale=1, exp_id="b"),
+    ]
+    paths = export_experiments(layer_data, tmp_path, particles_format="dynamo", workers=2)
+    assert sorted(Path(p).relative_to(tmp_path).as_posix() for p in paths) == [
+        "a/a_-_image.mrc",
+        "a/a_-_positions.tbl",
+        "b/b_-_positions.tbl",
+    ]
+
+
+def test_write_lazy_image(tmp_path, monkeypatch):
+    monkeypatch.setattr("blik.writer.MRC_WRITE_CHUNK_BYTES", 400)
+    data = np.random.rand(10, 10, 10).astype(np.float32)
+    attributes = {"metadata": {"experiment_id": "a"}, "scale": [2] * 3}
+
+    write_image(tmp_path / "lazy.mrc", da.from_array(data, chunks=(3, 10, 10)), attributes)
+    with mrcfile.open(tmp_path / "lazy.mrc") as mrc:
+        np.testing.assert_array_equal(mrc.data, data)
+        assert np.isclose(mrc.header.rms, data.std())
+        assert mrc.voxel_size.x == 2
+
+    write_image(tmp_path / "int8.mrc", da.from_array(data), attributes, dtype=np.int8)
+    with mrcfile.open(tmp_path / "int8.mrc") as mrc:
+        assert mrc.data.dtype == np.int8
+        assert mrc.data.min() == -128 and mrc.data.max() == 127
+
+
+def test_write_int32_labels(tmp_path):
+    # label values beyond 16 bit are kept (as float32) rather than clipped
+    labels = np.zeros((4, 5, 6), np.int32)
+    labels[1, 2, 3] = 70_000
+    labels[2] = -5
+    attributes = {"metadata": {"experiment_id": "a"}, "scale": [1] * 3}
+    for name, data in (("eager", labels), ("lazy", da.from_array(labels, chunks=2))):
+        write_image(tmp_path / f"{name}.mrc", data, attributes)
+        with mrcfile.open(tmp_path / f"{name}.mrc") as mrc:
+            assert mrc.data.dtype == np.float32
+            np.testing.assert_array_equal(mrc.data, labels)
@@ -1,10 +1,54 @@
+import gc
+import time
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+import dask.array as da
 import mrcfile
 import napari
 import numpy as np
+import pytest
+from morphosamplers.preprocess import get_label_paths_3d
+from morphosamplers.sampler import sample_volume_around_surface
+from morphosamplers.surface_spline import GriddedSplineSurface
+from qtpy import sip
+from scipy.fft import fftn, fftshift
+from scipy.spatial.transform import Rotation
+from skimage.filters import butterworth
 
+import blik.filters
+from blik.cache import _volume_cache, materialized
+from blik.fft import amplitude_spectrum, averaged_amplitude_spectrum, radial_profile
+from blik.filters import bandpass, bandpass_transfer, gaussian_smooth
+from blik.reader import construct_particle_layer_tuples
+from blik.utils import (
+    generate_vector_colors,
+    generate_vectors,
+    invert_xyz,
+    layer_tuples_to_layers,
+    orientation_features,
+    stratified_subsample,
+)
+from blik.widgets import main_widget
 from blik.widgets.file_reader import file_reader
 from blik.widgets.filter import bandpass_filter, gaussian_filter
-from blik.widgets.main_widget import MainBlikWidget
+from blik.widgets.main_widget import (
+    MainBlikWidget,
+    _connect_points_to_vectors,
+    _disconnect_removed_layer,
+    _layer_snapshot,
+    _release_removed_layer,
+    _synced_layers,
+    flush_vectors_updates,
+)
+from blik.widgets.picking import (
+    _resample_surface,
+    _resample_surfaces,
+    _resampled_writer,
+    _surface_grid_params,
+    _surface_lines_from_labels,
+)
 
 
 def test_main_widget(make_napari_viewer):
@@ -40,6 +84,160 @@ def test_main_widget(make_napari_viewer):
     assert lay.metadata["experiment_id"] == "test"
 
 
+def test_points_vectors_sync(qapp):
+    pts, vec = layer_tuples_to_layers(
+        construct_particle_layer_tuples(
+            coords=np.random.rand(10, 3) * 100,
+            features=orientation_features(Rotation.random(10, random_state=0)),
+            scale=1,
+            exp_id="test",
+        )
+    )
+    _connect_points_to_vectors(pts, vec)
+
+    def assert_synced():
+        flush_vectors_updates()
+        expected, colors = generate_vectors(
+            invert_xyz(pts.data), pts.features.orientation.rotation
+        )
+        np.testing.assert_allclose(vec.data, invert_xyz(expected))
+        np.testing.assert_allclose(vec.edge_color[:, :3], colors)
+
+    pts.add([[1, 2, 3]])
+    pts.add([[4, 5, 6]])
+    # updates are coalesced until the next frame or an explicit flush
+    assert len(vec.data) == 30
+    assert_synced()
+    pts.remove([0, 4])
+    assert_synced()
+    pts.features.orientation.set(Rotation.from_euler("z", 30, degrees=True), index=[2])
+    pts.events.features()
+    assert_synced()
+    pts.data = pts.data + 1
+    assert_synced()
+
+    # rebuilding does not write into the data the vectors layer holds
+    shown = vec.data
+    before = shown.copy()
+    pts.features.orientation.set(Rotation.random(len(pts.data), random_state=1))
+    _synced_layers[pts].rebuild()
+    np.testing.assert_array_equal(shown, before)
+    assert_synced()
+
+
+def test_vector_colors_cache(monkeypatch):
+    monkeypatch.setattr("blik.utils.VECTOR_COLORS_CACHE_MAX_BYTES", 3 * 3 * 8 * 100)
+    colors = generate_vector_colors(100)
+    assert generate_vector_colors(100) is colors
+    assert not colors.flags.writeable
+    # over the size limit, the least recently used colors are dropped
+    generate_vector_colors(50)
+    assert generate_vector_colors(100) is not colors
+
+
+def test_points_vectors_sync_release():
+    viewer = napari.components.ViewerModel()
+    viewer.layers.events.removed.connect(_disconnect_removed_layer)
+    tuples = construct_particle_layer_tuples(
+        coords=np.random.rand(10, 3) * 100,
+        features=orientation_features(Rotation.random(10, random_state=0)),
+        scale=1,
+        exp_id="test",
+    )
+    pts, vec = layer_tuples_to_layers(tuples)
+    viewer.add_layer(pts)
+    viewer.add_layer(vec)
+    _connect_points_to_vectors(pts, vec, viewer=viewer)
+    assert pts in _synced_layers
+    viewer.layers.remove(vec)
+    assert pts not in _synced_layers
+
+    # layers deleted without a viewer are not kept alive by the sync
+    pts, vec = layer_tuples_to_layers(tuples)
+    _connect_points_to_vectors(pts, vec)
+    pts_ref = weakref.ref(pts)
+    del pts, vec
+    gc.collect()
+    assert pts_ref() is None
+
+
+def test_release_removed_layer_volume():
+    viewer = napari.components.ViewerModel()
+    viewer.layers.events.removed.connect(_release_removed_layer)
+    layer = viewer.add_image(da.zeros((8, 8, 8), chunks=4))
+    materialized(layer.data)
+    assert _volume_cache.get(layer.data) is not None
+    # napari keeps removed layers alive for a while, the cached volume must not wait for it
+    viewer.layers.remove(layer)
+    assert _volume_cache.get(layer.data) is None
+
+
+def test_stratified_subsample():
+    coords = np.random.default_rng(0).random((10_000, 3)) * 100
+    idx = stratified_subsample(coords, 500)
+    assert len(idx) == 500
+    assert np.all(np.diff(idx) > 0)
+    # spread over the whole volume
+    octants = ((coords[idx] > 50) * [1, 2, 4]).sum(axis=1)
+    assert len(np.unique(octants)) == 8
+    np.testing.assert_array_equal(stratified_subsample(coords[:10], 500), np.arange(10))
+
+
+def test_points_vectors_sync_subset(monkeypatch):
+    monkeypatch.setattr(main_widget, "MAX_DISPLAYED_ORIENTATIONS", 20)
+    rng = np.random.default_rng(0)
+    # two groups of particles, far from the middle of the volume along z
+    coords = rng.random((200, 3)) * [200, 1000, 1000]
+    coords[100:, 0] += 800
+    viewer = napari.components.ViewerModel()
+    pts, vec = layer_tuples_to_layers(
+        construct_particle_layer_tuples(
+            coords=invert_xyz(coords),
+            features=orientation_features(Rotation.random(200, random_state=0)),
+            scale=1,
+            exp_id="test",
+        )
+    )
+    viewer.add_layer(pts)
+    viewer.add_layer(vec)
+    _connect_points_to_vectors(pts, vec, viewer=viewer)
+    viewer.dims.ndisplay = 3
+    flush_vectors_updates()
+    # 3D: a spatial subsample of all particles
+    assert len(vec.data) == 20 * 3
+
+    viewer.dims.ndisplay = 2
+    viewer.dims.set_point(0, 100)
+    flush_vectors_updates()
+    shown = np.unique(vec.data[:, 0], axis=0)
+    assert len(shown) == 20
+    assert np.all(np.abs(shown[:, 0] - 100) <= main_widget.ORIENTATIONS_SLICE_MARGIN_A + 0.5)
+
+    # no particle close to this slice
+    viewer.dims.set_point(0, 500)
+    flush_vectors_updates()
+    assert len(vec.data) == 0
+    pts.features.orientation.set(Rotation.from_euler("z", 30, degrees=True), index=[0])
+    pts.events.features()
+    pts.data = pts.data + 1
+    flush_vectors_updates()
+    assert len(vec.data) == 0
+
+
+def test_export_snapshot():
+    viewer = napari.components.ViewerModel()
+    pts = viewer.add_points(np.zeros((3, 3)), features={"a": [1, 2, 3]}, metadata={"experiment_id": "a"})
+    labels = viewer.add_labels(np.zeros((4, 4, 4), np.uint8))
+    pts_data, pts_state, _ = _layer_snapshot(pts)
+    labels_data, _, _ = _layer_snapshot(labels)
+    # edits made while exporting do not change what is written
+    pts.data[0] = 1
+    pts.features.loc[0, "a"] = 10
+    labels.data[0] = 1
+    assert not pts_data.any() and not labels_data.any()
+    assert pts_state["features"]["a"][0] == 1
+
+
 def test_reader_widget(make_napari_viewer, star_file):
     viewer = make_napari_viewer()
     wdg = file_reader()
@@ -63,8 +261,25 @@ def test_gaussian_filter_widget(make_napari_viewer, mrc_file):
     assert wdg.image.value == layer
     wdg()
 
+    wdg.mode.value = "smoothed layer"
+    wdg()
+    smoothed = viewer.layers[f"smoothed {layer.name}"]
+    assert smoothed.data.dtype == np.float32
+    wdg.sigma.value = 2
+    assert len(viewer.layers) == 2
+
+
+def test_gaussian_smooth():
+    data = np.random.default_rng(0).normal(size=(20, 30, 30)).astype(np.float32)
+    smoothed = gaussian_smooth(data, 1.5)
+    assert smoothed.dtype == np.float32
+    assert gaussian_smooth(data, 1.5) is smoothed
+    lazy = gaussian_smooth(da.from_array(data, chunks=(5, 30, 30)), 1.5)
+    assert isinstance(lazy, da.Array)
+    np.testing.assert_allclose(lazy.compute(), smoothed, atol=1e-6)
 
-def test_bandpass_filter_widget(make_napari_viewer, mrc_file):
+
+def test_bandpass_filter_widget(make_napari_viewer, mrc_file, qtbot):
     viewer = make_napari_viewer()
     wdg = bandpass_filter()
     viewer.window.add_dock_widget(wdg)
@@ -74,5 +289,190 @@ def test_bandpass_filter_widget(make_napari_viewer, mrc_file):
         )
     assert wdg.image.value == layer
     wdg()
+    qtbot.waitUntil(lambda: len(viewer.layers) == 2)
     result = viewer.layers[-1].data
     assert np.all(result != 1)
+
+    wdg.image.value = layer
+    wdg.preview.value = True
+    preview = viewer.layers[f"bandpass preview {layer.name}"]
+    assert preview.data.shape == (1, *layer.data.shape[1:])
+    wdg.preview.value = False
+    assert preview not in viewer.layers
+
+
+def test_bandpass_preview_follows_dims(qapp):
+    viewer = napari.components.ViewerModel()
+    image = viewer.add_image(np.random.rand(10, 10, 10).astype(np.float32))
+    wdg = bandpass_filter()
+    wdg.viewer.bind(viewer)
+    wdg.image.bind(image)
+    callbacks = len(viewer.dims.events.current_step.callbacks)
+
+    # the displayed section is only followed while previewing
+    wdg.preview.value = True
+    assert len(viewer.dims.events.current_step.callbacks) == callbacks + 1
+    viewer.dims.set_current_step(0, 3)
+    assert viewer.layers["bandpass preview Image"].translate[0] == 3
+    wdg.preview.value = False
+    assert len(viewer.dims.events.current_step.callbacks) == callbacks
+    assert len(viewer.layers) == 1
+    wdg.preview.value = True
+    sip.delete(wdg.native)
+    assert len(viewer.dims.events.current_step.callbacks) == callbacks
+
+
+def test_cancel_job(qtbot, monkeypatch):
+    # one section per slab, each slow enough to cancel the job in between
+    monkeypatch.setattr("blik.filters.BANDPASS_CHUNK_BYTES", 16 * 16 * 4)
+    filtered_slabs = []
+
+    def slow_block(block, *args, **kwargs):
+        filtered_slabs.append(block)
+        time.sleep(0.02)
+        return block
+
+    monkeypatch.setattr("blik.filters._bandpass_block", slow_block)
+    viewer = napari.components.ViewerModel()
+    image = viewer.add_image(np.random.rand(50, 16, 16).astype(np.float32))
+    wdg = bandpass_filter()
+    cancel_button = wdg[-1]
+    assert cancel_button.text == "Cancel"
+
+    worker = wdg(viewer, image, 0.1, 0.4, True)
+    returned = []
+    worker.returned.connect(returned.append)
+    worker.returned.connect(lambda layer_data: viewer._add_layer_from_data(*layer_data))
+    with qtbot.waitSignal(worker.finished):
+        worker.yielded.connect(lambda _: cancel_button.native.click())
+    # the job stopped early, and its result was never added
+    assert len(filtered_slabs) < 50
+    assert not returned
+    assert len(viewer.layers) == 1
+
+
+def test_bandpass():
+    data = np.random.default_rng(0).normal(size=(20, 33, 34)).astype(np.float32)
+    expected = butterworth(butterworth(data, 0.1, high_pass=True), 0.4, high_pass=False)
+    filtered = bandpass(data, 0.1, 0.4)
+    assert filtered.dtype == np.float32
+    np.testing.assert_allclose(filtered, expected, atol=1e-5)
+
+    lazy = bandpass(da.from_array(data, chunks=(5, 33, 34)), 0.1, 0.4, is_2D_data=True)
+    assert isinstance(lazy, da.Array)
+    expected = butterworth(
+        butterworth(data, 0.1, high_pass=True, channel_axis=0), 0.4, high_pass=False, channel_axis=0
+    )
+    np.testing.assert_allclose(lazy.compute(), expected, atol=1e-5)
+
+
+def test_bandpass_lowpass_lazy(monkeypatch):
+    # without high-pass, volumes are not merged into a single chunk: slabs only overlap a little
+    monkeypatch.setattr("blik.filters.BANDPASS_CHUNK_BYTES", 33 * 34 * 4 * 8)
+    data = np.random.default_rng(0).normal(size=(40, 33, 34)).astype(np.float32)
+    lazy = bandpass(da.from_array(data, chunks=(5, 33, 34)), 0, 0.2)
+    assert lazy.numblocks[0] > 1
+    # away from the ends of the volume (periodic in the eager fft)
+    np.testing.assert_allclose(lazy.compute()[5:-5], bandpass(data, 0, 0.2)[5:-5], atol=5e-3)
+
+
+def test_bandpass_transfer_cache(monkeypatch):
+    monkeypatch.setattr("blik.filters._transfer_cache", OrderedDict())
+    # room for two 10x10x10 transfers (10x10x6 float32 each)
+    monkeypatch.setattr("blik.filters.BANDPASS_TRANSFER_CACHE_MAX_BYTES", 4800)
+    transfer = bandpass_transfer((10, 10, 10), 0.1, 0.3)
+    assert bandpass_transfer((10, 10, 10), 0.1, 0.3) is transfer
+    assert not transfer.flags.writeable
+    bandpass_transfer((10, 10, 10), 0.1, 0.2)
+    bandpass_transfer((10, 10, 10), 0.1, 0.4)
+    assert bandpass_transfer((10, 10, 10), 0.1, 0.3) is not transfer
+    # too big to be cached at all
+    bandpass_transfer((20, 20, 20), 0.1, 0.3)
+    assert len(blik.filters._transfer_cache) == 2
+
+
+def test_amplitude_spectrum():
+    data = np.random.default_rng(0).normal(size=(7, 8, 9))
+    spectrum = amplitude_spectrum(data)
+    assert spectrum.dtype == np.float32
+    np.testing.assert_allclose(spectrum, np.abs(fftshift(fftn(data))), rtol=1e-4, atol=1e-4)
+    spectrum = amplitude_spectrum(data, axes=(-2, -1))
+    np.testing.assert_allclose(
+        spectrum, np.abs(fftshift(fftn(data, axes=(-2, -1)), axes=(-2, -1))), rtol=1e-4, atol=1e-4
+    )
+
+
+def test_averaged_amplitude_spectrum():
+    data = np.random.default_rng(0).normal(size=(6, 32, 40)).astype(np.float32)
+    expected = np.sqrt(np.mean(np.abs(fftshift(fftn(data, axes=(1, 2)), axes=(1, 2))) ** 2, axis=0))
+    spectrum = averaged_amplitude_spectrum(da.from_array(data, chunks=(2, 32, 40)))
+    np.testing.assert_allclose(spectrum, expected, rtol=1e-4)
+    assert averaged_amplitude_spectrum(data, tile_size=16).shape == (16, 16)
+
+    freq, profile = radial_profile(spectrum)
+    assert len(freq) == len(profile) == 17
+    assert freq[0] == 0 and freq[-1] == 0.5
+
+
+def test_resample_surface_cropped():
+    volume = np.random.default_rng(0).random((60, 70, 80)).astype(np.float32)
+    lines = [np.stack([np.linspace(20, 60, 6), np.full(6, y), np.full(6, 30.0)], axis=1) for y in (20, 35, 50)]
+    surf = GriddedSplineSurface(points=lines, separation=3)
+    expected = sample_volume_around_surface(volume.T, surf, 10, 3, interpolation_order=3)
+    resampled = _resample_surface(da.from_array(volume, chunks=20), surf, 3, 10, masked=False)
+    np.testing.assert_allclose(resampled, expected, atol=1e-4)
+
+
+def _run(gen):
+    try:
+        while True:
+            next(gen)
+    except StopIteration as e:
+        return e.value
+
+
+def test_resample_surfaces_parallel(tmp_path):
+    volume = np.random.default_rng(0).random((60, 70, 80)).astype(np.float32)
+    params = []
+    for x in (20.0, 40.0, 60.0):
+        lines = [np.stack([np.linspace(20, 50, 6), np.full(6, y), np.full(6, x)], axis=1) for y in (20, 35, 50)]
+        params.append(_surface_grid_params(GriddedSplineSurface(points=lines, separation=3)))
+
+    serial = _run(_resample_surfaces(volume, params, 3, 10, False, 1))
+    parallel = _run(_resample_surfaces(volume, params, 3, 10, False, 3))
+    for vol_serial, vol_parallel in zip(serial, parallel):
+        np.testing.assert_array_equal(vol_serial, vol_parallel)
+
+    with pytest.raises(ValueError):
+        _resampled_writer(Path(), ["a", "b", "c"], "exp", np.ones(3))
+    store = _resampled_writer(tmp_path, ["a", "b", "c"], "exp", np.ones(3))
+    paths = _run(_resample_surfaces(volume, params, 3, 10, False, 3, store))
+    assert [p.name for p in paths] == ["a.mrc", "b.mrc", "c.mrc"]
+    with mrcfile.open(paths[1]) as mrc:
+        np.testing.assert_allclose(mrc.data, serial[1], rtol=1e-6)
+
+
+def test_surface_lines_from_labels():
+    z, y, x = np.mgrid[:50, :60, :60]
+    labels = np.zeros((50, 60, 60), dtype=np.uint8)
+    for center, radius in (((20, 20, 20), 12), ((27, 42, 42), 10)):
+        dist = np.sqrt(sum((c - center[i]) ** 2 for i, c in enumerate((z, y, x))))
+        labels[(dist < radius) & (dist >= radius - 3)] = 1
+    expected = get_label_paths_3d(labels, slicing_step=5, sampling_step=5)
+    lines = list(_surface_lines_from_labels(labels, slicing_step=5, sampling_step=5, workers=2))
+    assert [len(surf) for surf in lines] == [len(surf) for surf in expected]
+    for surf, surf_expected in zip(lines, expected):
+        for line, line_expected in zip(surf, surf_expected):
+            np.testing.assert_allclose(invert_xyz(line), line_expected)
+
+    # touching objects with different label values are different surfaces
+    labels = np.zeros((20, 30, 30), dtype=np.uint8)
+    labels[5:15, 5:25, 5:15] = 1
+    labels[5:15, 5:25, 15:25] = 2
+    expected = get_label_paths_3d(labels, slicing_step=5, sampling_step=5)
+    lines = list(_surface_lines_from_labels(labels, slicing_step=5, sampling_step=5))
+    assert len(lines) == len(expected) == 2
+    assert [len(surf) for surf in lines] == [len(surf) for surf in expected]
+    for surf, surf_expected in zip(lines, expected):
+        for line, line_expected in zip(surf, surf_expected):
+            np.testing.assert_allclose(invert_xyz(line), line_expected)